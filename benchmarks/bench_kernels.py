@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the distance functions and the kernels, recording the wall
+time and the peak memory of every case.
+
+    python benchmarks/bench_kernels.py --save baseline.json
+    python benchmarks/bench_kernels.py --compare baseline.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy as np
+
+# benchmark the checked out tree, not an installed release of BOlib
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import bolib.models.gp.kernels.exponential as exponential
+import bolib.models.gp.kernels.gamma_exponential15 as gamma_exponential15
+import bolib.models.gp.kernels.matern32 as matern32
+import bolib.models.gp.kernels.matern52 as matern52
+import bolib.models.gp.kernels.rational_quadratic2 as rational_quadratic2
+import bolib.models.gp.kernels.squared_exponential as squared_exponential
+import bolib.models.gp.kernels.util as util
+
+KERNELS = [
+    ('squared_exponential', squared_exponential),
+    ('matern52', matern52),
+    ('matern32', matern32),
+    ('exponential', exponential),
+    ('gamma_exponential15', gamma_exponential15),
+    ('rational_quadratic2', rational_quadratic2),
+]
+
+FUNCTIONS = ['kernel_function', 'dk_dx', 'dk_dl']
+
+UTIL_FUNCTIONS = [
+    ('util.sq_distance', util.sq_distance),
+    ('util.dr_dx', util.dr_dx),
+    ('util.dr_dl', util.dr_dl),
+]
+
+
+def cases(sizes, dims):
+    """ Every benchmark case: the function, its name and its inputs. """
+    random_state = np.random.RandomState(0)
+    for size_a in sizes:
+        for size_b in sizes + [None]:
+            for n_dims in dims:
+                mat_a = random_state.uniform(-1.0, 1.0, (size_a, n_dims))
+                mat_b = mat_a if size_b is None else \
+                    random_state.uniform(-1.0, 1.0, (size_b, n_dims))
+                for ard in [True, False]:
+                    lengthscale = random_state.uniform(0.5, 2.0, (
+                        n_dims if ard else 1,))
+                    params = {
+                        'n': size_a,
+                        'm': size_a if size_b is None else size_b,
+                        'd': n_dims,
+                        'symmetric': size_b is None,
+                        'ard': ard,
+                    }
+                    for name, function in UTIL_FUNCTIONS:
+                        yield name, function, \
+                            (mat_a, mat_b, lengthscale), params
+                    for kernel_name, kernel in KERNELS:
+                        for function in FUNCTIONS:
+                            yield '{}.{}'.format(kernel_name, function), \
+                                getattr(kernel, function), \
+                                (mat_a, mat_b, lengthscale), params
+
+
+def measure(function, args, repeat):
+    """ Best wall time, in seconds, of repeat calls, and peak memory, in
+    bytes, of one more call. """
+    times = []
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        function(*args)
+        times.append(timeit.default_timer() - start)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            function(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return min(times), peak
+
+
+def case_key(name, params):
+    """ Identifier of a case, stable across runs. """
+    return '{} n={n} m={m} d={d} symmetric={symmetric} ard={ard}'.format(
+        name, **params)
+
+
+def run(sizes, dims, repeat, select=None):
+    """ Runs every case whose name contains select. """
+    results = {}
+    for name, function, args, params in cases(sizes, dims):
+        if select is not None and select not in name:
+            continue
+        seconds, peak = measure(function, args, repeat)
+        record = dict(params, name=name, seconds=seconds, peak_bytes=peak)
+        results[case_key(name, params)] = record
+        print('{:<70} {:>10.3f} ms {:>10} KiB'.format(
+            case_key(name, params), 1e3 * seconds,
+            '-' if peak is None else peak // 1024))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Cases slower, or with a higher peak memory, than threshold times
+    their baseline. """
+    regressions = []
+    for key, record in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in ['seconds', 'peak_bytes']:
+            old, new = baseline[key][metric], record[metric]
+            if old and new and new > threshold * old:
+                regressions.append((key, metric, old, new))
+
+    return regressions
+
+
+def main(argv=None):
+    """ Command line entry point. """
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the BOlib kernels.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 200],
+                        help='numbers of solutions of A and B')
+    parser.add_argument('--dims', type=int, nargs='+', default=[2, 10],
+                        help='numbers of dimensions')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed calls per case, the best is kept')
+    parser.add_argument('--select', default=None,
+                        help='run only the cases whose name contains it')
+    parser.add_argument('--save', default=None,
+                        help='JSON file to save the results in')
+    parser.add_argument('--compare', default=None,
+                        help='JSON baseline to compare the results with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='ratio to the baseline flagged as regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.dims, args.repeat, args.select)
+    if args.save is not None:
+        with open(args.save, 'w') as output:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'results': results,
+            }, output, indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'],
+                                  args.threshold)
+        for key, metric, old, new in regressions:
+            print('REGRESSION {} {}: {:.4g} -> {:.4g} ({:.2f}x)'.format(
+                key, metric, old, new, new / old))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+
+class DistanceBasis(object):
+    """ Squared differences in every dimension between two fixed sets of
+    solutions, which do not depend on the lengthscale.
+
+    The distance matrix for any lengthscale is a single weighted
+    contraction of the basis, and the same basis gives the gradient in
+    the length-scale hyper-parameter space, so the work per evaluation in
+    a hyper-parameter fitting loop is one product and the element-wise
+    kernel terms. For the symmetric case only the upper triangle is
+    stored. """
+
+    def __init__(self, mat_a, mat_b=None, dtype=np.float64):
+        """
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns,
+         None or mat_a itself for the symmetric self-covariance.
+        :type mat_b: np.array
+        :param dtype: Floating point type of the computation.
+        :type dtype: np.dtype
+        """
+        profiling = bolib.models.gp.kernels.profiling
+        if profiling.ENABLED:
+            stamp = profiling.clock()
+        self.symmetric = mat_b is None or mat_b is mat_a
+        mat_a = np.asarray(mat_a, dtype=dtype)
+        mat_b = mat_a if self.symmetric else np.asarray(mat_b, dtype=dtype)
+        self.shape = (mat_a.shape[0], mat_b.shape[0])
+
+        if self.symmetric:
+            rows, cols = np.triu_indices(mat_a.shape[0])
+            sq_diff = mat_a[rows] - mat_a[cols]
+        else:
+            sq_diff = (mat_a[:, np.newaxis, :] - mat_b[np.newaxis, :, :])
+            sq_diff = sq_diff.reshape(-1, mat_a.shape[1])
+        self.sq_diff = np.square(sq_diff, out=sq_diff)
+        if profiling.ENABLED:
+            profiling.record(profiling.kernel_name(DistanceBasis), 'distance',
+                             stamp, (self.sq_diff,))
+
+    @classmethod
+    def from_sq_diff(cls, sq_diff, shape, symmetric):
+        """ Builds a basis from squared differences already measured, e.g.
+        loaded from disk.
+
+        :param sq_diff: Squared differences, as in the sq_diff attribute.
+        :type sq_diff: np.array
+        :param shape: Shape of the distance matrix.
+        :type shape: tuple
+        :param symmetric: Whether sq_diff holds the upper triangle only.
+        :type symmetric: bool
+        :return: Distance basis.
+        :rtype: DistanceBasis """
+        result = cls.__new__(cls)
+        result.symmetric = symmetric
+        result.shape = tuple(shape)
+        result.sq_diff = sq_diff
+
+        return result
+
+    def sq_distance(self, lengthscale):
+        """ Measures the distance matrix for the given lengthscale.
+
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Distance matrix, packed when it is symmetric.
+        :rtype: np.array """
+        profiling = bolib.models.gp.kernels.profiling
+        if not profiling.ENABLED:
+            return self._sq_distance(lengthscale)
+
+        stamp = profiling.clock()
+        result = self._sq_distance(lengthscale)
+        profiling.record(profiling.kernel_name(DistanceBasis), 'distance',
+                         stamp, (result,))
+
+        return result
+
+    def evaluate(self, kernel, lengthscale, want=('k', 'dl')):
+        """ Measures the kernel function and its gradient in the
+        length-scale hyper-parameter space for the given lengthscale.
+
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :param want: Requested outputs: 'k' and/or 'dl'.
+        :type want: tuple
+        :return: Requested outputs, in the same order as in want.
+        :rtype: tuple """
+        unknown = [name for name in want if name not in ('k', 'dl')]
+        if unknown:
+            raise ValueError(
+                "Unknown distance basis outputs: {}".format(unknown))
+
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        if profile:
+            recorded = profiling.kernel_name(kernel)
+            n_dims = self.sq_diff.shape[1]
+            profiling.count(recorded, want, (self.shape[0], n_dims),
+                            (self.shape[1], n_dims))
+            stamp = profiling.clock()
+        sq_dist = self._sq_distance(lengthscale)
+        if profile:
+            stamp = profiling.record(recorded, 'distance', stamp, (sq_dist,))
+        value, grad_r2 = kernel.stationary_terms(
+            sq_dist, value='k' in want, gradient='dl' in want,
+            overwrite=True)
+        results = {}
+        if 'k' in want:
+            results['k'] = self._unpack(value)
+        if profile:
+            stamp = profiling.record(recorded, 'elementwise', stamp,
+                                     (value, grad_r2, results.get('k')),
+                                     reuse=sq_dist)
+        if 'dl' in want:
+            grad = self.sq_diff * grad_r2[:, np.newaxis]
+            grad *= -2.0 * self._weights(lengthscale, 3.0)
+            results['dl'] = self._unpack(grad.T, axis=True)
+            if profile:
+                profiling.record(recorded, 'gradient', stamp,
+                                 (grad, results['dl']))
+
+        return tuple(results[name] for name in want)
+
+    def _sq_distance(self, lengthscale):
+        """ Distance matrix for the given lengthscale, unrecorded. """
+        return np.dot(self.sq_diff, self._weights(lengthscale, 2.0))
+
+    def _weights(self, lengthscale, power):
+        """ Lengthscale to the minus power, for every dimension. """
+        lengthscale = np.asarray(lengthscale, dtype=self.sq_diff.dtype)
+
+        return np.broadcast_to(np.power(lengthscale.ravel(), -power),
+                               self.sq_diff.shape[1:])
+
+    def _unpack(self, flat, axis=False):
+        """ Reshapes flat values of the basis into matrices, moving the
+        leading axis to the end when axis is set. """
+        if self.symmetric:
+            result = bolib.models.gp.kernels.util.unpack_upper(flat)
+        else:
+            result = flat.reshape(flat.shape[:-1] + self.shape)
+        if axis:
+            result = np.ascontiguousarray(np.moveaxis(result, 0, -1))
+
+        return result
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+
+import numpy as np
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+
+class CandidateCache(object):
+    """ Kernel matrix between a fixed set of candidate solutions and a
+    growing set of training solutions.
+
+    The candidates divided by the lengthscale, their squared norms and the
+    columns of the kernel matrix already measured are kept, so that only
+    the columns of newly appended training solutions are measured. The
+    cache is evicted when the candidates or the lengthscale change. """
+
+    def __init__(self, kernel, dtype=np.float64, capacity=16):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param dtype: Floating point type of the computation.
+        :type dtype: np.dtype
+        :param capacity: Initial number of training solutions the buffers
+         can hold.
+        :type capacity: int
+        """
+        self.kernel = kernel
+        self.dtype = dtype
+        self.initial_capacity = max(capacity, 1)
+        self.clear()
+
+    def clear(self):
+        """ Evicts the cached candidates and kernel matrix columns. """
+        self.key = None
+        self.size = 0
+        self._lengthscale = None
+        self._scaled = None
+        self._sq_norm = None
+        self._train = None
+        self._columns = None
+
+    def cross_covariance(self, candidates, mat_x, lengthscale):
+        """ Measures the kernel matrix between the candidates and the
+        training solutions, reusing the columns of the training solutions
+        already seen.
+
+        :param candidates: List of candidate solutions in lines and
+         dimensions in columns.
+        :type candidates: np.array
+        :param mat_x: List of training solutions in lines and dimensions in
+         columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Kernel matrix between the candidates and the training
+         solutions, a view of the cache.
+        :rtype: np.array """
+        util = bolib.models.gp.kernels.util
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        candidates = np.asarray(candidates, dtype=self.dtype)
+        mat_x = np.asarray(mat_x, dtype=self.dtype)
+        lengthscale = util.as_lengthscale(lengthscale, self.dtype)
+        if profile:
+            kernel = profiling.kernel_name(self.kernel)
+            profiling.count(kernel, ('k',), candidates.shape, mat_x.shape)
+            stamp = profiling.clock()
+
+        key = (_digest(candidates), _digest(lengthscale))
+        if key != self.key:
+            self.clear()
+            self.key = key
+            self._lengthscale = lengthscale
+            self._scaled = util.scale(candidates, lengthscale, self.dtype)
+            self._sq_norm = util.sq_norm(self._scaled)
+            self._allocate(max(self.initial_capacity, mat_x.shape[0]))
+
+        if mat_x.shape[0] < self.size or not np.array_equal(
+                mat_x[:self.size], self._train[:self.size]):
+            self.size = 0
+        if mat_x.shape[0] > self._train.shape[0]:
+            self._allocate(max(2 * self._train.shape[0], mat_x.shape[0]))
+
+        old, new = self.size, mat_x.shape[0]
+        if new > old:
+            scaled_new = util.scale(mat_x[old:], self._lengthscale,
+                                    self.dtype)
+            sq_dist = util.scaled_sq_distance(
+                scaled_new, self._scaled, sq_norm_b=self._sq_norm)
+            if profile:
+                stamp = profiling.record(kernel, 'distance', stamp,
+                                         (sq_dist,))
+            value = self.kernel.stationary_terms(
+                sq_dist, gradient=False, overwrite=True)[0]
+            self._columns[old:new] = value
+            if profile:
+                profiling.record(kernel, 'elementwise', stamp, (value,),
+                                 reuse=sq_dist)
+            self._train[old:new] = mat_x[old:]
+            self.size = new
+
+        return self._columns[:self.size].T
+
+    def _allocate(self, capacity):
+        """ Reallocates the buffers to hold capacity training solutions,
+        keeping the columns already measured. """
+        size = self.size
+        train = np.empty((capacity, self._scaled.shape[1]), dtype=self.dtype)
+        columns = np.empty((capacity, self._scaled.shape[0]),
+                           dtype=self.dtype)
+        if size:
+            train[:size] = self._train[:size]
+            columns[:size] = self._columns[:size]
+        self._train, self._columns = train, columns
+
+
+def _digest(array):
+    """ Content hash of an array, its shape and type. """
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(str((array.shape, array.dtype.str)).encode())
+    digest.update(array.view(np.uint8))
+
+    return digest.hexdigest()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.sparse
+import scipy.spatial
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+
+def neighbours(mat_a, mat_b, lengthscale, radius=1.0):
+    """ Finds the pairs of solutions of A and B whose distance is within the
+    support radius, through k-d trees on the solutions divided by the
+    lengthscale.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns,
+     None or mat_a itself for the pairs of A and itself.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param radius: Support radius, in units of the lengthscale.
+    :type radius: float
+    :return: Rows and columns of the pairs, and the differences between
+     their solutions divided by the lengthscale.
+    :rtype: tuple """
+    util = bolib.models.gp.kernels.util
+    symmetric = mat_b is None or mat_b is mat_a
+    scaled_a = util.scale(mat_a, lengthscale)
+    scaled_b = scaled_a if symmetric else util.scale(mat_b, lengthscale)
+    tree_a = scipy.spatial.cKDTree(scaled_a)
+    tree_b = tree_a if symmetric else scipy.spatial.cKDTree(scaled_b)
+    pairs = tree_a.sparse_distance_matrix(tree_b, radius,
+                                          output_type='ndarray')
+    rows, cols = pairs['i'], pairs['j']
+
+    return rows, cols, scaled_a[rows] - scaled_b[cols]
+
+
+def evaluate(stationary_terms, mat_a, mat_b, lengthscale,
+             want=bolib.models.gp.kernels.util.OUTPUTS, radius=1.0,
+             max_dims=None):
+    """
+    Measures a compactly supported kernel function and its gradients
+    between solutions of A and B, only for the pairs within the support
+    radius, as sparse matrices.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivative with respect to the squared distance element-wise to the
+     distance matrix, zero beyond the support radius.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns,
+     None or mat_a itself for the symmetric self-covariance.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k' for the kernel matrix, 'dx' for its
+     gradient in X and 'dl' for its gradient in the length-scale
+     hyper-parameter space.
+    :type want: tuple
+    :param radius: Support radius of the kernel, in units of the
+     lengthscale.
+    :type radius: float
+    :param max_dims: Largest number of dimensions in which the kernel
+     function is positive definite, if it is bounded.
+    :type max_dims: int
+    :raises ValueError: If the solutions have more than max_dims
+     dimensions, where the kernel matrices would be indefinite.
+    :return: Requested outputs, in the same order as in want. The kernel
+     matrix is a (n, m) scipy.sparse.csr_matrix and every gradient a list
+     of d of them, one per dimension, sharing its sparsity pattern.
+    :rtype: tuple """
+    util = bolib.models.gp.kernels.util
+    util.check_want(want)
+    mat_a = np.asarray(mat_a, dtype=np.float64)
+    mat_b = mat_a if mat_b is None or mat_b is mat_a else \
+        np.asarray(mat_b, dtype=np.float64)
+    if max_dims is not None and mat_a.shape[-1] > max_dims:
+        raise ValueError(
+            "The kernel is only positive definite in up to {} dimensions, "
+            "not {}".format(max_dims, mat_a.shape[-1]))
+    lengthscale = np.broadcast_to(
+        util.as_lengthscale(lengthscale, stacked=False),
+        mat_a.shape[-1:])
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    if profile:
+        kernel = profiling.kernel_name(stationary_terms)
+        profiling.count(kernel, want, mat_a.shape, mat_b.shape)
+        stamp = profiling.clock()
+    rows, cols, diff = neighbours(mat_a, mat_b, lengthscale, radius)
+    shape = (mat_a.shape[0], mat_b.shape[0])
+    sq_dist = util.sq_norm(diff)
+    if profile:
+        stamp = profiling.record(kernel, 'distance', stamp,
+                                 (rows, cols, diff, sq_dist))
+
+    value, grad_r2 = stationary_terms(
+        sq_dist, value='k' in want, gradient=util.wants_gradient(want),
+        overwrite=True)
+    results = {}
+    if 'k' in want:
+        results['k'] = _sparse(value, rows, cols, shape)
+    if profile:
+        stamp = profiling.record(kernel, 'elementwise', stamp,
+                                 (value, grad_r2), reuse=sq_dist)
+    if 'dx' in want:
+        # dr/dx = 2 (a - b) / l^2 = 2 diff / l
+        results['dx'] = [
+            _sparse(2.0 * grad_r2 * diff[:, dim] / lengthscale[dim],
+                    rows, cols, shape)
+            for dim in range(mat_a.shape[1])]
+    if 'dl' in want:
+        # dr/dl = -2 (a - b)^2 / l^3 = -2 diff^2 / l
+        results['dl'] = [
+            _sparse(-2.0 * grad_r2 * np.square(diff[:, dim]) /
+                    lengthscale[dim], rows, cols, shape)
+            for dim in range(mat_a.shape[1])]
+    if profile:
+        profiling.record(kernel, 'gradient', stamp, [
+            matrix.data for name in ('dx', 'dl') if name in want
+            for matrix in results[name]])
+
+    return tuple(results[name] for name in want)
+
+
+def _sparse(data, rows, cols, shape):
+    """ Sparse matrix with the given entries. """
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=shape)
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import os
+
+import numpy as np
+
+import bolib.models.gp.kernels.basis
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+DISK_CACHE_BYTES = 2 ** 30
+
+# files of the cache, so that it leaves any other file of the directory be
+PREFIX = 'bolib-'
+
+try:
+    TEXT_TYPES = (str, unicode)
+except NameError:
+    TEXT_TYPES = (str,)
+
+
+class DiskCache(object):
+    """ Content-addressed cache of distance matrices, kernel matrices and
+    distance bases in a directory, so that they survive restarts.
+
+    Every entry is a .npy file named after PREFIX and a SHA-1 hash of what
+    it was measured from: the solutions, the kernel and the lengthscale.
+    Entries are memory-mapped, read-only, both when they are loaded and
+    when they are stored. Loading an entry refreshes its modification time,
+    and the least recently used entries are evicted whenever the directory
+    outgrows max_bytes. The size of the directory is scanned on creation
+    and then tracked through put, so entries written by other processes are
+    only accounted for at the next eviction. Only the files of the cache,
+    entries and the temporary files of interrupted writes, are counted and
+    evicted. """
+
+    def __init__(self, directory, max_bytes=DISK_CACHE_BYTES):
+        """
+        :param directory: Directory of the cache, created if needed.
+        :type directory: str
+        :param max_bytes: Maximum size of the entries in the directory.
+        :type max_bytes: int
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.evict()
+
+    def path(self, key):
+        """ File of an entry.
+
+        :param key: Key of the entry, as returned by key.
+        :type key: str
+        :return: Path of the .npy file.
+        :rtype: str """
+        return os.path.join(self.directory, PREFIX + key + '.npy')
+
+    def get(self, key):
+        """ Loads an entry, memory-mapped, marking it as recently used.
+
+        :param key: Key of the entry, as returned by key.
+        :type key: str
+        :return: Stored array, or None if it is not cached.
+        :rtype: np.memmap """
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        if profile:
+            stamp = profiling.clock()
+        path = self.path(key)
+        try:
+            os.utime(path, None)
+            result = np.load(path, mmap_mode='r')
+        except (IOError, OSError):
+            result = None
+        if profile:
+            profiling.record(profiling.kernel_name(DiskCache), 'cache',
+                             stamp)
+
+        return result
+
+    def put(self, key, array):
+        """ Stores an entry, evicting the least recently used ones if the
+        cache outgrows its size. The file is written under a temporary name
+        and renamed, so that readers never see partial entries.
+
+        :param key: Key of the entry, as returned by key.
+        :type key: str
+        :param array: Array to store.
+        :type array: np.array
+        :return: Stored entry, memory-mapped read-only as get loads it, or
+         a read-only view of array if it does not fit in the cache.
+        :rtype: np.memmap """
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        if profile:
+            stamp = profiling.clock()
+        path = self.path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as output:
+                np.save(output, np.asarray(array))
+                written = output.tell()
+            os.rename(temporary, path)
+        finally:
+            # left behind only if the write failed
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        self.size += written - replaced
+        if self.size > self.max_bytes:
+            self.evict()
+        try:
+            result = np.load(path, mmap_mode='r')
+        except (IOError, OSError):
+            result = np.asarray(array).view()
+            result.flags.writeable = False
+        if profile:
+            profiling.record(profiling.kernel_name(DiskCache), 'cache',
+                             stamp)
+
+        return result
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in
+        its size, rescanning the directory to refresh the tracked size. The
+        temporary files of interrupted writes count as entries, the oldest
+        ones, and are removed first. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.startswith(PREFIX) or \
+                    not name.endswith(('.npy', '.tmp')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.size = total
+
+    def clear(self):
+        """ Removes every entry, leaving any other file of the directory.
+        """
+        max_bytes, self.max_bytes = self.max_bytes, -1
+        try:
+            self.evict()
+        finally:
+            self.max_bytes = max_bytes
+
+    def cached(self, key, function, *args):
+        """ Loads an entry, or measures it with function(*args) and stores
+        it.
+
+        :param key: Key of the entry, as returned by key.
+        :type key: str
+        :param function: Function measuring the entry on a miss.
+        :type function: function
+        :return: Stored array, memory-mapped read-only whether it was loaded
+         or measured.
+        :rtype: np.memmap """
+        result = self.get(key)
+        if result is None:
+            result = self.put(key, function(*args))
+
+        return result
+
+    def sq_distance(self, mat_a, mat_b, lengthscale):
+        """ Measures, or loads, the distance matrix between solutions of A
+        and B.
+
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns,
+         None for mat_a itself.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Distance matrix, memory-mapped read-only.
+        :rtype: np.memmap """
+        util = bolib.models.gp.kernels.util
+        if mat_b is None or mat_b is mat_a:
+            return self.cached(
+                key('sq_distance_symmetric', mat_a, lengthscale),
+                util.sq_distance_symmetric, mat_a, lengthscale)
+
+        return self.cached(key('sq_distance', mat_a, mat_b, lengthscale),
+                           util.sq_distance_array, mat_a, mat_b, lengthscale)
+
+    def kernel_function(self, kernel, mat_a, mat_b, lengthscale,
+                        dtype=np.float64):
+        """ Measures, or loads, the kernel matrix between solutions of A and
+        B.
+
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns,
+         None or mat_a itself for the symmetric self-covariance.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :param dtype: Floating point type of the computation, or util.MIXED.
+        :type dtype: np.dtype
+        :return: Kernel matrix, memory-mapped read-only whether it was
+         loaded or measured. Copy it to modify it, e.g. to add noise to its
+         diagonal.
+        :rtype: np.memmap """
+        profiling = bolib.models.gp.kernels.profiling
+        symmetric = mat_b is None or mat_b is mat_a
+        if not isinstance(dtype, TEXT_TYPES):
+            dtype = np.dtype(dtype).str
+        if symmetric:
+            entry = key(kernel.__name__, dtype, 'symmetric', mat_a,
+                        lengthscale)
+        else:
+            entry = key(kernel.__name__, dtype, mat_a, mat_b, lengthscale)
+
+        result = self.get(entry)
+        if result is None:
+            result = self.put(entry, kernel.evaluate(
+                mat_a, None if symmetric else mat_b, lengthscale,
+                want=('k',), dtype=dtype)[0])
+        elif profiling.ENABLED:
+            # the evaluation counts itself on a miss
+            profiling.count(profiling.kernel_name(kernel), ('k',),
+                            np.shape(mat_a),
+                            np.shape(mat_a if symmetric else mat_b))
+
+        return result
+
+    def distance_basis(self, mat_a, mat_b=None):
+        """ Measures, or loads, the distance basis between solutions of A
+        and B (see bolib.models.gp.kernels.basis).
+
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns,
+         None or mat_a itself for the symmetric self-covariance.
+        :type mat_b: np.array
+        :return: Distance basis, with its squared differences memory-mapped
+         read-only whether they were loaded or measured.
+        :rtype: bolib.models.gp.kernels.basis.DistanceBasis """
+        basis = bolib.models.gp.kernels.basis
+        symmetric = mat_b is None or mat_b is mat_a
+        mat_b = mat_a if symmetric else mat_b
+        entry = key('distance_basis', symmetric, mat_a, mat_b)
+        sq_diff = self.get(entry)
+        if sq_diff is None:
+            sq_diff = self.put(entry, basis.DistanceBasis(
+                mat_a, None if symmetric else mat_b).sq_diff)
+
+        return basis.DistanceBasis.from_sq_diff(
+            sq_diff, (np.shape(mat_a)[0], np.shape(mat_b)[0]), symmetric)
+
+
+def key(*parts):
+    """ Content hash of strings, numbers and arrays, with the shape and type
+    of the arrays.
+
+    :return: Hexadecimal SHA-1 digest.
+    :rtype: str """
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, TEXT_TYPES):
+            digest.update(b's' + part.encode('utf-8'))
+            continue
+        array = np.atleast_1d(np.ascontiguousarray(part))
+        digest.update(str((array.shape, array.dtype.str)).encode())
+        digest.update(array.view(np.uint8))
+
+    return digest.hexdigest()
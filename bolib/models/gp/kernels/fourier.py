@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import bolib.models.gp.kernels.util
+
+FEATURE_OUTPUTS = ('phi', 'dx', 'dl')
+
+
+class RandomFeatures(object):
+    """ Random Fourier feature map of a stationary kernel.
+
+    The features of a solution x are
+    phi(x) = sqrt(2 / D) cos(W (x / l) + b), with the D frequencies W
+    sampled from the spectral density of the kernel and the phases b
+    uniformly from [0, 2 pi), so that phi(A) phi(B)^T approximates the
+    kernel matrix between A and B with an error of order 1 / sqrt(D).
+    The frequencies are sampled once, with unit lengthscale, so the
+    features stay a smooth function of the lengthscale. """
+
+    def __init__(self, kernel, n_dims, n_features=1024, random_state=None):
+        """
+        :param kernel: Kernel module with a spectral_sample function, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param n_dims: Number of dimensions of the solutions.
+        :type n_dims: int
+        :param n_features: Number of random features D.
+        :type n_features: int
+        :param random_state: Seed or source of randomness.
+        :type random_state: np.random.RandomState
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        self.kernel = kernel
+        self.frequencies = kernel.spectral_sample(
+            n_features, n_dims, random_state)
+        self.phases = random_state.uniform(0.0, 2.0 * np.pi, n_features)
+
+    @property
+    def n_features(self):
+        """ Number of random features. """
+        return self.frequencies.shape[0]
+
+    def features(self, mat_x, lengthscale):
+        """ Measures the random features of the solutions.
+
+        :param mat_x: List of solutions in lines and dimensions in columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: (n, D) features, one line per solution.
+        :rtype: np.array """
+        return self.evaluate(mat_x, lengthscale, want=('phi',))[0]
+
+    def kernel_function(self, mat_a, mat_b, lengthscale):
+        """ Approximates the kernel matrix between solutions of A and B by
+        the inner products of their features.
+
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Approximate kernel matrix.
+        :rtype: np.array """
+        features_a = self.features(mat_a, lengthscale)
+        features_b = features_a if mat_b is mat_a else \
+            self.features(mat_b, lengthscale)
+
+        return np.dot(features_a, features_b.T)
+
+    def evaluate(self, mat_x, lengthscale, want=FEATURE_OUTPUTS):
+        """ Measures the random features and their gradients in X and in the
+        length-scale hyper-parameter space at once, sharing the projection
+        of the solutions among them.
+
+        :param mat_x: List of solutions in lines and dimensions in columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :param want: Requested outputs: 'phi' for the (n, D) features, 'dx'
+         for their (n, D, d) gradient in X and 'dl' for their (n, D, d)
+         gradient in the length-scale hyper-parameter space.
+        :type want: tuple
+        :return: Requested outputs, in the same order as in want.
+        :rtype: tuple """
+        unknown = [name for name in want if name not in FEATURE_OUTPUTS]
+        if unknown:
+            raise ValueError(
+                "Unknown random feature outputs: {}".format(unknown))
+
+        util = bolib.models.gp.kernels.util
+        mat_x = np.asarray(mat_x, dtype=np.float64)
+        lengthscale = np.broadcast_to(
+            util.as_lengthscale(lengthscale, stacked=False),
+            mat_x.shape[-1:])
+        weight = np.sqrt(2.0 / self.n_features)
+        projection = np.dot(util.scale(mat_x, lengthscale),
+                            self.frequencies.T)
+        projection += self.phases
+
+        results = {}
+        if 'phi' in want:
+            results['phi'] = np.cos(projection)
+            results['phi'] *= weight
+        if 'dx' in want or 'dl' in want:
+            # d phi / d z, with z the projection
+            sine = np.sin(projection, out=projection)
+            sine *= -weight
+            # dz/dx = W / l
+            scaled_freq = self.frequencies / lengthscale
+            if 'dx' in want:
+                results['dx'] = sine[:, :, np.newaxis] * scaled_freq
+            if 'dl' in want:
+                # dz/dl = -W x / l^2
+                results['dl'] = sine[:, :, np.newaxis] * scaled_freq * \
+                    (mat_x / -lengthscale)[:, np.newaxis, :]
+
+        return tuple(results[name] for name in want)
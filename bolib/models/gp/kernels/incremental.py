@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+
+class IncrementalGram(object):
+    """ Kernel matrix between a growing set of solutions and itself.
+
+    The solutions divided by the lengthscale and their squared norms are
+    cached, so appending k solutions to a set of n only measures the
+    distances of the n x k and k x k new blocks, which are discarded once
+    the kernel function is applied. The buffers grow geometrically. """
+
+    def __init__(self, kernel, mat_x, lengthscale, dtype=np.float64,
+                 capacity=16):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param mat_x: Initial list of solutions in lines and dimensions in
+         columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :param dtype: Floating point type of the computation.
+        :type dtype: np.dtype
+        :param capacity: Initial number of solutions the buffers can hold.
+        :type capacity: int
+        """
+        mat_x = np.asarray(mat_x, dtype=dtype)
+        self.kernel = kernel
+        self.lengthscale = np.array(
+            bolib.models.gp.kernels.util.as_lengthscale(lengthscale, dtype))
+        self.size = 0
+
+        capacity = max(capacity, mat_x.shape[0], 1)
+        self._scaled = np.empty((capacity, mat_x.shape[1]), dtype=dtype)
+        self._sq_norm = np.empty(capacity, dtype=dtype)
+        self._gram = np.empty((capacity, capacity), dtype=dtype)
+
+        self.append(mat_x)
+
+    @property
+    def capacity(self):
+        """ Number of solutions the buffers can hold without growing. """
+        return self._gram.shape[0]
+
+    @property
+    def gram(self):
+        """ Kernel matrix between the solutions, a view of the buffer. """
+        return self._gram[:self.size, :self.size]
+
+    @property
+    def mat_x(self):
+        """ Solutions in lines and dimensions in columns. """
+        return self._scaled[:self.size] * \
+            np.asarray(self.lengthscale).ravel()
+
+    def append(self, mat_new):
+        """ Appends solutions, measuring only the new rows and columns of the
+        kernel matrix.
+
+        :param mat_new: List of solutions in lines and dimensions in
+         columns.
+        :type mat_new: np.array
+        :return: Kernel matrix between all the solutions.
+        :rtype: np.array """
+        util = bolib.models.gp.kernels.util
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        scaled_new = util.scale(mat_new, self.lengthscale,
+                                self._gram.dtype)
+        old, new = self.size, self.size + scaled_new.shape[0]
+        if profile:
+            kernel = profiling.kernel_name(self.kernel)
+            profiling.count(kernel, ('k',), scaled_new.shape,
+                            (new, scaled_new.shape[1]))
+            stamp = profiling.clock()
+        if new > self.capacity:
+            self._grow(max(2 * self.capacity, new))
+
+        self._scaled[old:new] = scaled_new
+        self._sq_norm[old:new] = util.sq_norm(scaled_new)
+        cross_dist = util.scaled_sq_distance(
+            self._scaled[:old], scaled_new, self._sq_norm[:old],
+            self._sq_norm[old:new])
+        block_dist = util.sq_distance_symmetric(
+            scaled_new, 1.0, self._gram.dtype)
+        if profile:
+            stamp = profiling.record(kernel, 'distance', stamp,
+                                     (cross_dist, block_dist))
+        cross = self.kernel.stationary_terms(
+            cross_dist, gradient=False, overwrite=True)[0]
+        block = self.kernel.stationary_terms(
+            block_dist, gradient=False, overwrite=True)[0]
+        self._gram[:old, old:new] = cross
+        self._gram[old:new, :old] = cross.T
+        self._gram[old:new, old:new] = block
+        if profile:
+            profiling.record(kernel, 'elementwise', stamp, (cross, block),
+                             reuse=(cross_dist, block_dist))
+        self.size = new
+
+        return self.gram
+
+    def _grow(self, capacity):
+        """ Reallocates the buffers to hold capacity solutions. """
+        size = self.size
+        scaled = np.empty((capacity, self._scaled.shape[1]),
+                          dtype=self._scaled.dtype)
+        scaled[:size] = self._scaled[:size]
+        norms = np.empty(capacity, dtype=self._sq_norm.dtype)
+        norms[:size] = self._sq_norm[:size]
+        gram = np.empty((capacity, capacity), dtype=self._gram.dtype)
+        gram[:size, :size] = self._gram[:size, :size]
+
+        self._scaled, self._sq_norm, self._gram = scaled, norms, gram
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+import numpy as np
+
+# The fused loops measure every pair of solutions without materializing any
+# intermediate array. The backend is opt-in: util keeps to NumPy unless
+# ENABLED is set, or BOLIB_JIT=1 is in the environment, and Numba is
+# available. Importing Numba and compiling a loop per kernel takes seconds
+# in every new process, more than the loops save on the few hundred
+# solutions of most optimizations, so it is never selected automatically.
+# Numba is only imported once the backend is used, and the loops are only
+# compiled on their first call. Without Numba they stay plain Python
+# functions.
+ENABLED = os.environ.get('BOLIB_JIT', '0') not in ('', '0')
+
+_NUMBA = []
+
+_LOOPS = {}
+
+
+def _numba():
+    """ Numba module, imported on the first call, or None without it. """
+    if not _NUMBA:
+        try:
+            import numba
+        except ImportError:
+            numba = None
+        _NUMBA.append(numba)
+
+    return _NUMBA[0]
+
+
+def available():
+    """ Whether Numba is installed, importing it on the first call.
+
+    :return: Whether the loops are compiled.
+    :rtype: bool """
+    return _numba() is not None
+
+
+def _compile(function, parallel=False):
+    """ Compiles function with Numba, when it is available. """
+    numba = _numba()
+    if numba is None:
+        return function
+
+    return numba.njit(parallel=parallel, cache=True)(function)
+
+
+def _loop(function):
+    """ Serial loop, compiled on the first call: util may call it from the
+    threads of its own tiles. """
+    if function not in _LOOPS:
+        _LOOPS[function] = _compile(function)
+
+    return _LOOPS[function]
+
+
+def _sq_distance(mat_a, mat_b, inv_sq, out):
+    """ Fused loop of the distance matrix. """
+    for i in range(mat_a.shape[0]):
+        for j in range(mat_b.shape[0]):
+            sq_dist = 0.0
+            for dim in range(mat_a.shape[1]):
+                diff = mat_a[i, dim] - mat_b[j, dim]
+                sq_dist += diff * diff * inv_sq[dim]
+            out[i, j] = sq_dist
+
+
+def _dr_dx(mat_a, mat_b, inv_sq, out):
+    """ Fused loop of the gradient of the distance in X. """
+    for i in range(mat_a.shape[0]):
+        for j in range(mat_b.shape[0]):
+            for dim in range(mat_a.shape[1]):
+                out[i, j, dim] = \
+                    2.0 * (mat_a[i, dim] - mat_b[j, dim]) * inv_sq[dim]
+
+
+def _dr_dl(mat_a, mat_b, inv_cube, out):
+    """ Fused loop of the gradient of the distance in the length-scale
+    hyper-parameter space. """
+    for i in range(mat_a.shape[0]):
+        for j in range(mat_b.shape[0]):
+            for dim in range(mat_a.shape[1]):
+                diff = mat_a[i, dim] - mat_b[j, dim]
+                out[i, j, dim] = -2.0 * diff * diff * inv_cube[dim]
+
+
+_EVALUATORS = {}
+
+
+def _evaluator(scalar_terms):
+    """ Fused loop of the kernel function and its gradients, compiled once
+    per kernel. """
+    if scalar_terms in _EVALUATORS:
+        return _EVALUATORS[scalar_terms]
+
+    terms = _compile(scalar_terms)
+    numba = _numba()
+    prange = range if numba is None else numba.prange
+
+    def fused(mat_a, mat_b, inv_sq, inv_cube, value, grad_x, grad_l):
+        """ Fused loop of the kernel function and its gradients. """
+        want_k = value.size > 0
+        want_dx = grad_x.size > 0
+        want_dl = grad_l.size > 0
+        for i in prange(mat_a.shape[0]):
+            for j in range(mat_b.shape[0]):
+                sq_dist = 0.0
+                for dim in range(mat_a.shape[1]):
+                    diff = mat_a[i, dim] - mat_b[j, dim]
+                    sq_dist += diff * diff * inv_sq[dim]
+                k_value, grad_r2 = terms(sq_dist)
+                if want_k:
+                    value[i, j] = k_value
+                for dim in range(mat_a.shape[1]):
+                    diff = mat_a[i, dim] - mat_b[j, dim]
+                    if want_dx:
+                        grad_x[i, j, dim] = \
+                            2.0 * grad_r2 * diff * inv_sq[dim]
+                    if want_dl:
+                        grad_l[i, j, dim] = \
+                            -2.0 * grad_r2 * diff * diff * inv_cube[dim]
+
+    _EVALUATORS[scalar_terms] = _compile(fused, parallel=True)
+
+    return _EVALUATORS[scalar_terms]
+
+
+def _inverse_powers(mat_a, lengthscale):
+    """ Inverse squared and cubed lengthscale, one per dimension. """
+    lengthscale = np.broadcast_to(
+        np.asarray(lengthscale, dtype=np.float64), (mat_a.shape[1],))
+
+    return 1.0 / lengthscale ** 2, 1.0 / lengthscale ** 3
+
+
+def _empty(shape, dtype, out=None):
+    """ Output buffer, allocated when out is None. """
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+
+    return out
+
+
+def sq_distance(mat_a, mat_b, lengthscale, out=None, dtype=np.float64):
+    """ Measures the distance matrix between solutions of A and B.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m) to store the result in.
+    :type out: np.array
+    :param dtype: Floating point type of the result.
+    :type dtype: np.dtype
+    :return: Distance matrix between solutions of A and B.
+    :rtype: np.array """
+    inv_sq, _ = _inverse_powers(mat_a, lengthscale)
+    out = _empty((mat_a.shape[0], mat_b.shape[0]), dtype, out)
+    _loop(_sq_distance)(mat_a, mat_b, inv_sq, out)
+
+    return out
+
+
+def dr_dx(mat_a, mat_b, lengthscale, out=None, dtype=np.float64):
+    """ Measures gradient of the distance between solutions of A and B in X.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param dtype: Floating point type of the result.
+    :type dtype: np.dtype
+    :return: 3D array with the gradient in every dimension of X.
+    :rtype: np.array """
+    inv_sq, _ = _inverse_powers(mat_a, lengthscale)
+    out = _empty(mat_a.shape[:1] + mat_b.shape, dtype, out)
+    _loop(_dr_dx)(mat_a, mat_b, inv_sq, out)
+
+    return out
+
+
+def dr_dl(mat_a, mat_b, lengthscale, out=None, dtype=np.float64):
+    """ Measures gradient of the distance between solutions of A and B in the
+    length-scale hyper-parameter space.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param dtype: Floating point type of the result.
+    :type dtype: np.dtype
+    :return: 3D array with the gradient in every dimension the length-scale
+     hyper-parameter space.
+    :rtype: np.array """
+    _, inv_cube = _inverse_powers(mat_a, lengthscale)
+    out = _empty(mat_a.shape[:1] + mat_b.shape, dtype, out)
+    _loop(_dr_dl)(mat_a, mat_b, inv_cube, out)
+
+    return out
+
+
+def evaluate(scalar_terms, mat_a, mat_b, lengthscale, want, buffers,
+             dtype=np.float64, n_jobs=1):
+    """ Measures the kernel function and its gradients between solutions of
+    A and B in a single fused loop, parallel across rows of A.
+
+    :param scalar_terms: Function that returns the kernel function and its
+     derivative with respect to the squared distance of a single distance.
+    :type scalar_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param buffers: Buffers to store the outputs in, in the same order as
+     in want. None entries are allocated.
+    :type buffers: list
+    :param dtype: Floating point type of the outputs.
+    :type dtype: np.dtype
+    :param n_jobs: Number of threads of the loop, at most the ones Numba
+     was started with.
+    :type n_jobs: int
+    :return: Requested outputs, in the same order as in want.
+    :rtype: tuple """
+    inv_sq, inv_cube = _inverse_powers(mat_a, lengthscale)
+    shapes = {'k': (mat_a.shape[0], mat_b.shape[0]),
+              'dx': mat_a.shape[:1] + mat_b.shape,
+              'dl': mat_a.shape[:1] + mat_b.shape}
+    results = dict(
+        (name, _empty(shapes[name], dtype, buffer))
+        for name, buffer in zip(want, buffers))
+    empty = dict(
+        (name, np.empty((0,) * len(shape), dtype=dtype))
+        for name, shape in shapes.items())
+    arrays = [results.get(name, empty[name]) for name in ('k', 'dx', 'dl')]
+    numba = _numba()
+    if numba is None:
+        _evaluator(scalar_terms)(mat_a, mat_b, inv_sq, inv_cube, *arrays)
+        return tuple(results[name] for name in want)
+
+    threads = numba.get_num_threads()
+    numba.set_num_threads(max(1, min(n_jobs,
+                                     numba.config.NUMBA_NUM_THREADS)))
+    try:
+        _evaluator(scalar_terms)(mat_a, mat_b, inv_sq, inv_cube, *arrays)
+    finally:
+        numba.set_num_threads(threads)
+
+    return tuple(results[name] for name in want)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import bolib.models.gp.kernels.util
+
+
+class KroneckerGram(object):
+    """ Kernel matrix between the solutions of a Cartesian grid and
+    themselves, kept as the Kronecker product K_1 x ... x K_d of the 1-D
+    kernel matrices of every dimension.
+
+    The squared exponential kernel factorizes over dimensions, so its
+    matrix is exact. The other kernels are taken in product form,
+    k(x, y) = prod_d k(x_d, y_d). Storage is O(sum n_d^2) and a product
+    with a vector costs O(N sum n_d), with N = prod n_d solutions. """
+
+    def __init__(self, kernel, axes, lengthscale):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.squared_exponential.
+        :type kernel: module
+        :param axes: Coordinates of the grid in every dimension.
+        :type axes: list
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        """
+        util = bolib.models.gp.kernels.util
+        self.kernel = kernel
+        self.axes = [np.asarray(axis, dtype=np.float64).reshape(-1, 1)
+                     for axis in axes]
+        self.lengthscale = np.broadcast_to(
+            util.as_lengthscale(lengthscale, stacked=False),
+            (len(self.axes),))
+        self.factors = [
+            np.asarray(kernel.stationary_function(util.sq_distance(
+                axis, axis, self.lengthscale[dim:dim + 1])))
+            for dim, axis in enumerate(self.axes)]
+        self._eigh = None
+
+    @property
+    def shape(self):
+        """ Shape of the full kernel matrix. """
+        size = int(np.prod([axis.shape[0] for axis in self.axes]))
+        return size, size
+
+    def points(self):
+        """ Solutions of the grid, in the order of the rows of the kernel
+        matrix: the last dimension varies the fastest.
+
+        :return: List of solutions in lines and dimensions in columns.
+        :rtype: np.array """
+        grids = np.meshgrid(*[axis.ravel() for axis in self.axes],
+                            indexing='ij')
+
+        return np.stack(grids, axis=-1).reshape(-1, len(self.axes))
+
+    def dense(self):
+        """ Full kernel matrix, for small grids.
+
+        :return: Kernel matrix.
+        :rtype: np.array """
+        result = np.ones((1, 1))
+        for factor in self.factors:
+            result = np.kron(result, factor)
+
+        return result
+
+    def matvec(self, vec):
+        """ Product of the kernel matrix with a vector or with the columns
+        of a matrix.
+
+        :param vec: (N,) vector or (N, k) matrix.
+        :type vec: np.array
+        :return: Product, with the shape of vec.
+        :rtype: np.array """
+        return kron_matvec(self.factors, vec)
+
+    def eigh(self):
+        """ Eigendecomposition of every 1-D kernel matrix, computed once.
+        The eigenvalues of the kernel matrix are the Kronecker product of
+        theirs, and its eigenvectors the Kronecker product of theirs.
+
+        :return: Lists of the eigenvalues and the eigenvectors of every
+         dimension.
+        :rtype: tuple """
+        if self._eigh is None:
+            decompositions = [np.linalg.eigh(factor)
+                              for factor in self.factors]
+            self._eigh = ([values for values, _ in decompositions],
+                          [vectors for _, vectors in decompositions])
+
+        return self._eigh
+
+    def eigenvalues(self):
+        """ Eigenvalues of the kernel matrix, in the order of the Kronecker
+        product of the eigenvectors.
+
+        :return: (N,) eigenvalues.
+        :rtype: np.array """
+        result = np.ones(1)
+        for values in self.eigh()[0]:
+            result = np.outer(result, values).ravel()
+
+        return result
+
+    def solve(self, vec, noise=0.0):
+        """ Solves (K + noise I) x = vec through the eigendecomposition of
+        the kernel matrix, in O(N sum n_d).
+
+        :param vec: (N,) vector or (N, k) matrix.
+        :type vec: np.array
+        :param noise: Variance added to the diagonal.
+        :type noise: float
+        :return: Solution, with the shape of vec.
+        :rtype: np.array """
+        vectors = self.eigh()[1]
+        rotated = kron_matvec([basis.T for basis in vectors], vec)
+        spectrum = self.eigenvalues() + noise
+        rotated /= spectrum.reshape((-1,) + (1,) * (rotated.ndim - 1))
+
+        return kron_matvec(vectors, rotated)
+
+    def gradient_factors(self):
+        """ Gradient of every 1-D kernel matrix in the lengthscale of its
+        dimension. The gradient of the kernel matrix in the d-th
+        lengthscale is the Kronecker product of the 1-D kernel matrices
+        with the d-th replaced by its gradient.
+
+        :return: List of (n_d, n_d) gradients.
+        :rtype: list """
+        return [
+            np.asarray(self.kernel.dk_dl(
+                axis, axis, self.lengthscale[dim:dim + 1]))[..., 0]
+            for dim, axis in enumerate(self.axes)]
+
+    def dk_dl_matvec(self, vec):
+        """ Products of the gradients of the kernel matrix in every
+        lengthscale with a vector or with the columns of a matrix.
+
+        :param vec: (N,) vector or (N, k) matrix.
+        :type vec: np.array
+        :return: Products, one per dimension, stacked in the first
+         dimension.
+        :rtype: np.array """
+        return np.stack([
+            kron_matvec(self.factors[:dim] + [gradient] +
+                        self.factors[dim + 1:], vec)
+            for dim, gradient in enumerate(self.gradient_factors())])
+
+
+def kron_matvec(factors, vec):
+    """ Product of the Kronecker product of square matrices with a vector or
+    with the columns of a matrix, without forming the Kronecker product.
+
+    :param factors: List of (n_d, n_d) matrices.
+    :type factors: list
+    :param vec: (N,) vector or (N, k) matrix, with N = prod n_d.
+    :type vec: np.array
+    :return: Product, with the shape of vec.
+    :rtype: np.array """
+    vec = np.asarray(vec)
+    tensor = vec.reshape([factor.shape[1] for factor in factors] + [-1])
+    for axis, factor in enumerate(factors):
+        tensor = np.moveaxis(
+            np.tensordot(factor, tensor, axes=(1, axis)), 0, axis)
+
+    return tensor.reshape(vec.shape)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.sparse.linalg
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+
+class KernelOperator(scipy.sparse.linalg.LinearOperator):
+    """ Matrix-free kernel matrix between solutions of A and B, as a
+    scipy.sparse.linalg.LinearOperator for iterative solvers such as
+    scipy.sparse.linalg.cg.
+
+    Products are computed tile by tile of rows of A: the kernel matrix of
+    a tile is measured, multiplied and discarded, so that memory stays
+    within max_bytes whatever the number of solutions. Tiles may be
+    computed by several threads. """
+
+    def __init__(self, kernel, mat_a, mat_b, lengthscale, noise=0.0,
+                 max_bytes=bolib.models.gp.kernels.util.MAX_BYTES,
+                 n_jobs=1, executor=None):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns,
+         None or mat_a itself for the symmetric self-covariance.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :param noise: Variance added to the diagonal of the symmetric
+         self-covariance.
+        :type noise: float
+        :param max_bytes: Memory budget of the intermediate arrays of a
+         tile.
+        :type max_bytes: int
+        :param n_jobs: Number of threads computing tiles concurrently, -1
+         for as many as processors.
+        :type n_jobs: int
+        :param executor: Optional executor to compute the tiles with
+         instead.
+        :type executor: concurrent.futures.Executor
+        """
+        self.symmetric = mat_b is None or mat_b is mat_a
+        if noise and not self.symmetric:
+            raise ValueError("Noise requires a symmetric kernel matrix")
+
+        self.kernel = kernel
+        self.mat_a = np.asarray(mat_a, dtype=np.float64)
+        self.mat_b = self.mat_a if self.symmetric else \
+            np.asarray(mat_b, dtype=np.float64)
+        self.lengthscale = lengthscale
+        self.noise = noise
+        self.max_bytes = max_bytes
+        self.n_jobs = bolib.models.gp.kernels.util.effective_n_jobs(n_jobs)
+        self.executor = executor
+        super(KernelOperator, self).__init__(
+            np.float64, (self.mat_a.shape[0], self.mat_b.shape[0]))
+
+    def _matmat(self, mat):
+        """ Product of the kernel matrix with the columns of mat. """
+        result = self._products('k', mat)
+        if self.noise:
+            result += self.noise * mat
+
+        return result
+
+    def _adjoint(self):
+        """ Kernel matrix between solutions of B and A. """
+        if self.symmetric:
+            return self
+
+        return KernelOperator(self.kernel, self.mat_b, self.mat_a,
+                              self.lengthscale, max_bytes=self.max_bytes,
+                              n_jobs=self.n_jobs, executor=self.executor)
+
+    def dk_dl_matmat(self, mat):
+        """ Products of the gradients of the kernel matrix in every
+        lengthscale with a vector or with the columns of a matrix.
+
+        :param mat: (m,) vector or (m, k) matrix.
+        :type mat: np.array
+        :return: Products, one per dimension, stacked in the first
+         dimension.
+        :rtype: np.array """
+        mat = np.asarray(mat, dtype=np.float64)
+        result = self._products('dl', mat.reshape(mat.shape[0], -1))
+
+        return result.reshape((result.shape[0], self.shape[0]) +
+                              mat.shape[1:])
+
+    def _products(self, name, mat):
+        """ Products of the requested output with the columns of mat,
+        computed tile by tile. """
+        util = bolib.models.gp.kernels.util
+        profiling = bolib.models.gp.kernels.profiling
+        if profiling.ENABLED:
+            # the tiles record their stages, the product counts one call
+            profiling.count(profiling.kernel_name(self.kernel), (name,),
+                            self.mat_a.shape, self.mat_b.shape)
+        mat = np.asarray(mat, dtype=np.float64)
+        shape = (self.shape[0], mat.shape[1])
+        if name != 'k':
+            shape = (self.mat_a.shape[1],) + shape
+        result = np.empty(shape)
+
+        def product_tile(tile):
+            """ Multiplies the tile of rows of the output. """
+            start, stop = tile
+            block, = util.evaluate_rows(
+                self.kernel.stationary_terms, self.mat_a, self.mat_b,
+                self.lengthscale, (name,), [None], np.float64,
+                self.symmetric, start, stop)
+            if name == 'k':
+                np.dot(block, mat, out=result[start:stop])
+            else:
+                result[:, start:stop] = np.matmul(
+                    np.moveaxis(block, -1, 0), mat)
+
+        util.map_tiles(product_tile, util.tile_rows(
+            self.mat_a, self.mat_b, (name,), np.float64, self.max_bytes,
+            min_tiles=4 * self.n_jobs if self.n_jobs > 1 else 1,
+            lengthscale=self.lengthscale), self.n_jobs, self.executor)
+
+        return result
@@ -17,10 +17,15 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
 
+import math
+
 import numpy as np
 
+import bolib.models.gp.kernels.prepared
 import bolib.models.gp.kernels.util
 
+SQRT_3 = math.sqrt(3.0)
+
 
 def stationary_function(sq_dist):
     """ It applies the Matern (v=3/2) kernel function
@@ -34,13 +39,92 @@ def stationary_function(sq_dist):
 
     :return: Result matrix with kernel function applied element-wise.
     :rtype: np.matrix """
-    dist = np.sqrt(sq_dist)
-    return np.matrix(np.multiply((1 + SQRT_3*dist), np.exp(-SQRT_3*dist)))
+    return bolib.models.gp.kernels.util.as_matrix(
+        stationary_terms(np.asarray(sq_dist), gradient=False)[0])
+
+
+def stationary_terms(sq_dist, value=True, gradient=True,
+                     overwrite=False, curvature=False):
+    """ It applies the Matern (v=3/2) kernel function and its derivative
+    with respect to the squared distance element-wise to the distance
+    matrix, computing their shared terms only once, in place.
+
+    :param sq_dist: Distance matrix
+    :type sq_dist: np.array
+    :param value: Whether the kernel function is required.
+    :type value: bool
+    :param gradient: Whether the derivative with respect to the squared
+     distance is required.
+    :type gradient: bool
+    :param overwrite: Whether sq_dist may be used as a work buffer.
+    :type overwrite: bool
+    :param curvature: Whether the second derivative with respect to the
+     squared distance is required too, as a third element.
+    :type curvature: bool
+
+    :return: Kernel function and its derivatives applied element-wise,
+     None in place of the ones not required.
+    :rtype: tuple """
+    # with s = sqrt(3) r: k = (1 + s) exp(-s) and dk/dr^2 = -3/2 exp(-s)
+    scaled = np.sqrt(sq_dist, out=sq_dist if overwrite else None)
+    scaled *= SQRT_3
+    exp_term = np.negative(scaled)
+    np.exp(exp_term, out=exp_term)
+    curv_r2 = None
+    if curvature:
+        # d2k/d(r^2)^2 = 9/4 exp(-s) / s, taken as zero at r = 0
+        curv_r2 = np.zeros_like(scaled)
+        np.divide(exp_term, scaled, out=curv_r2, where=scaled != 0.0)
+        curv_r2 *= 2.25
+    value_term = None
+    if value:
+        value_term = scaled
+        value_term += 1.0
+        value_term *= exp_term
+    grad_r2 = None
+    if gradient:
+        grad_r2 = np.multiply(exp_term, -1.5,
+                              out=None if value else exp_term)
+    if curvature:
+        return value_term, grad_r2, curv_r2
+    return value_term, grad_r2
+
+
+def scalar_terms(sq_dist):
+    """ It applies the Matern (v=3/2) kernel function and its derivative
+    with respect to the squared distance to a single distance, as the
+    compiled backend (see bolib.models.gp.kernels.jit) requires.
+
+    :param sq_dist: Distance
+    :type sq_dist: float
+
+    :return: Kernel function and its derivative.
+    :rtype: tuple """
+    scaled = SQRT_3 * math.sqrt(sq_dist)
+    exp_term = math.exp(-scaled)
+    return (1.0 + scaled) * exp_term, -1.5 * exp_term
+
 
-SQRT_3 = np.sqrt(3.0)
+def spectral_sample(n_features, n_dims, random_state):
+    """ Samples frequencies from the spectral density of the kernel with
+    unit lengthscale, a multivariate Student-t distribution with 3 degrees of
+    freedom, as random Fourier features
+    (see bolib.models.gp.kernels.fourier) require.
+
+    :param n_features: Number of frequencies.
+    :type n_features: int
+    :param n_dims: Number of dimensions of the solutions.
+    :type n_dims: int
+    :param random_state: Source of randomness.
+    :type random_state: np.random.RandomState
+    :return: Frequencies in lines and dimensions in columns.
+    :rtype: np.array """
+    return random_state.standard_normal((n_features, n_dims)) / np.sqrt(
+        random_state.chisquare(3.0, (n_features, 1)) / 3.0)
 
 
-def kernel_function(mat_a, mat_b, lengthscale):
+def kernel_function(mat_a, mat_b, lengthscale, n_jobs=1,
+                    executor=None):
     """ Measures the distance matrix between solutions of A and B, and applies
     the kernel function element-wise to the distance matrix.
     
@@ -49,16 +133,27 @@ def kernel_function(mat_a, mat_b, lengthscale):
     :param mat_b: List of solutions in lines and dimensions in columns.
     :type mat_b: np.matrix
     :param lengthscale: Array of lenghtscale parameters. One per dimension
-     in ARD case, only one element otherwise.  
+     in ARD case, only one element otherwise. A (L, d) array with L > 1
+     stacks L lengthscales, adding a leading dimension of size L to the
+     results, while a single row one is one lengthscale.
     :type lengthscale: np.array
+    :param n_jobs: Number of threads computing tiles of rows concurrently,
+     -1 for as many as processors.
+    :type n_jobs: int
+    :param executor: Optional executor to compute the tiles with instead.
+    :type executor: concurrent.futures.Executor
     :return: Result matrix with kernel function applied element-wise.
     :rtype: np.matrix """
-    sq_dist = bolib.models.gp.kernels.util.sq_distance(
-        mat_a, mat_b, lengthscale)
-    return stationary_function(sq_dist)
+    util = bolib.models.gp.kernels.util
+    return util.as_matrix(util.evaluate(
+        stationary_terms, mat_a, mat_b,
+        util.as_lengthscale(lengthscale, stacked=False), want=('k',),
+        n_jobs=n_jobs, executor=executor,
+        scalar_terms=scalar_terms)[0])
 
 
-def dk_dx(mat_a, mat_b, lengthscale):
+def dk_dx(mat_a, mat_b, lengthscale, out=None, n_jobs=1,
+          executor=None):
     """ 
     Measures gradient of the kernel function in X.
     
@@ -67,21 +162,30 @@ def dk_dx(mat_a, mat_b, lengthscale):
     :param mat_b: List of solutions in lines and dimensions in columns.
     :type mat_b: np.matrix
     :param lengthscale: Array of lenghtscale parameters. One per dimension
-     in ARD case, only one element otherwise.  
+     in ARD case, only one element otherwise. A (L, d) array with L > 1
+     stacks L lengthscales, adding a leading dimension of size L to the
+     results, while a single row one is one lengthscale.
     :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param n_jobs: Number of threads computing tiles of rows concurrently,
+     -1 for as many as processors.
+    :type n_jobs: int
+    :param executor: Optional executor to compute the tiles with instead.
+    :type executor: concurrent.futures.Executor
     :return: 3D array with the gradient of the kernel function in every
      dimension of X.
     :rtype: np.array """
-    dr_dx = bolib.models.gp.kernels.util.dr_dx(
-        mat_a, mat_b, lengthscale)
-    sq_dist = np.array(bolib.models.gp.kernels.util.sq_distance(
-        mat_a, mat_b, lengthscale))
-    dist = np.sqrt(sq_dist)
-    grad_r2 = -1.5*np.exp(-SQRT_3*dist)
-    return grad_r2[:, :, np.newaxis] * dr_dx
+    util = bolib.models.gp.kernels.util
+    return util.evaluate(
+        stationary_terms, mat_a, mat_b,
+        util.as_lengthscale(lengthscale, stacked=False), want=('dx',),
+        out=(out,), n_jobs=n_jobs, executor=executor,
+        scalar_terms=scalar_terms)[0]
 
 
-def dk_dl(mat_a, mat_b, lengthscale):
+def dk_dl(mat_a, mat_b, lengthscale, out=None, n_jobs=1,
+          executor=None):
     """ 
     Measures gradient of the kernel function in the length-scale
     hyper-parameter space.
@@ -91,15 +195,155 @@ def dk_dl(mat_a, mat_b, lengthscale):
     :param mat_b: List of solutions in lines and dimensions in columns.
     :type mat_b: np.matrix
     :param lengthscale: Array of lenghtscale parameters. One per dimension
-     in ARD case, only one element otherwise.  
+     in ARD case, only one element otherwise. A (L, d) array with L > 1
+     stacks L lengthscales, adding a leading dimension of size L to the
+     results, while a single row one is one lengthscale.
     :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param n_jobs: Number of threads computing tiles of rows concurrently,
+     -1 for as many as processors.
+    :type n_jobs: int
+    :param executor: Optional executor to compute the tiles with instead.
+    :type executor: concurrent.futures.Executor
     :return: 3D array with the gradient of the kernel function in every
      dimension the length-scale hyper-parameter space.
     :rtype: np.array """
-    dr_dl = bolib.models.gp.kernels.util.dr_dl(
-        mat_a, mat_b, lengthscale)
-    sq_dist = np.array(bolib.models.gp.kernels.util.sq_distance(
-        mat_a, mat_b, lengthscale))
-    dist = np.sqrt(sq_dist)
-    grad_r2 = -1.5*np.exp(-SQRT_3*dist)
-    return grad_r2[:, :, np.newaxis] * dr_dl
+    util = bolib.models.gp.kernels.util
+    return util.evaluate(
+        stationary_terms, mat_a, mat_b,
+        util.as_lengthscale(lengthscale, stacked=False), want=('dl',),
+        out=(out,), n_jobs=n_jobs, executor=executor,
+        scalar_terms=scalar_terms)[0]
+
+
+def d2k_dx2(mat_a, mat_b, lengthscale, diagonal=False):
+    """
+    Measures the second derivatives of the kernel function in X.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.matrix
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.matrix
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param diagonal: Whether to measure only the second derivatives in
+     every dimension, without the mixed ones.
+    :type diagonal: bool
+    :return: 4D array with the Hessian of the kernel function in X, or 3D
+     array with its diagonal.
+    :rtype: np.array """
+    util = bolib.models.gp.kernels.util
+    return util.d2k_dx2(
+        stationary_terms, mat_a, mat_b,
+        util.as_lengthscale(lengthscale, stacked=False), diagonal=diagonal)
+
+
+def evaluate(mat_a, mat_b, lengthscale, want=('k', 'dx', 'dl'),
+             out=None, dtype=np.float64, packed=False, max_bytes=None,
+             n_jobs=1, executor=None, mask_a=None, mask_b=None):
+    """
+    Measures the kernel function and its gradients in X and in the
+    length-scale hyper-parameter space at once, sharing the distance
+    matrix and the element-wise terms among them.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+     Leading dimensions, if any, stack independent lists of solutions.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns,
+     None or mat_a itself for the symmetric self-covariance.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param out: Optional buffers to store the outputs in, in the same order
+     as in want, np.memmap included.
+    :type out: tuple
+    :param dtype: Floating point type of the computation, np.float64,
+     np.float32 or util.MIXED for single precision cross-covariances with
+     exact near-zero distances.
+    :type dtype: np.dtype
+    :param packed: Whether to return the symmetric kernel matrix as its
+     packed upper triangle.
+    :type packed: bool
+    :param max_bytes: When given, the outputs are computed in tiles of rows
+     whose intermediate arrays fit in this amount of bytes.
+    :type max_bytes: int
+    :param n_jobs: Number of threads computing tiles of rows concurrently,
+     -1 for as many as processors.
+    :type n_jobs: int
+    :param executor: Optional executor to compute the tiles with instead.
+    :type executor: concurrent.futures.Executor
+    :param mask_a: Optional boolean mask of the valid solutions of A, as
+     returned by util.pad_batch.
+    :type mask_a: np.array
+    :param mask_b: Optional boolean mask of the valid solutions of B.
+    :type mask_b: np.array
+    :return: Requested outputs as C-contiguous plain arrays, in the same
+     order as in want.
+    :rtype: tuple """
+    return bolib.models.gp.kernels.util.evaluate(
+        stationary_terms, mat_a, mat_b, lengthscale, want=want, out=out,
+        dtype=dtype, packed=packed, max_bytes=max_bytes, n_jobs=n_jobs,
+        executor=executor, mask_a=mask_a, mask_b=mask_b,
+        scalar_terms=scalar_terms)
+
+
+def iter_evaluate(mat_a, mat_b, lengthscale, want=('k',), dtype=np.float64,
+                  max_bytes=bolib.models.gp.kernels.util.MAX_BYTES):
+    """
+    Measures the kernel function and its gradients tile by tile, holding
+    only a tile of rows of A in memory at once.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param dtype: Floating point type of the computation, or util.MIXED.
+    :type dtype: np.dtype
+    :param max_bytes: Memory budget of the intermediate arrays of a tile.
+    :type max_bytes: int
+    :return: Generator of the first and last (excluded) rows of every tile,
+     and the requested outputs of those rows.
+    :rtype: generator """
+    return bolib.models.gp.kernels.util.iter_evaluate(
+        stationary_terms, mat_a, mat_b, lengthscale, want=want, dtype=dtype,
+        max_bytes=max_bytes)
+
+
+def kernel_diag(mat_a, lengthscale, dtype=np.float64):
+    """
+    Measures the diagonal of the kernel matrix between solutions of A and
+    themselves, in linear time.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: Kernel function of every solution with itself.
+    :rtype: np.array """
+    return bolib.models.gp.kernels.util.kernel_diag(
+        stationary_terms, mat_a, lengthscale, dtype=dtype)
+
+
+class Matern32(bolib.models.gp.kernels.prepared.PreparedKernel):
+    """ Matern (v=3/2) kernel bound to a fixed set of training solutions
+    and lengthscale (see bolib.models.gp.kernels.prepared). """
+
+    __slots__ = ()
+
+    stationary_terms = staticmethod(stationary_terms)
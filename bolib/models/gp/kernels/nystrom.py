@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.linalg
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+SELECTION_METHODS = ('greedy', 'kmeans++')
+
+
+def select_inducing(kernel, mat_x, lengthscale, n_inducing,
+                    method='greedy', random_state=None):
+    """ Selects a subset of the solutions as inducing points.
+
+    The greedy variance method is a pivoted Cholesky factorization of the
+    kernel matrix: every step picks the solution worst explained by the
+    ones already picked, in O(n m^2). The k-means++ method spreads the
+    inducing points by sampling every solution with probability
+    proportional to its squared distance, divided by the lengthscale, to
+    the closest one already picked.
+
+    :param kernel: Kernel module, e.g. bolib.models.gp.kernels.matern52.
+    :type kernel: module
+    :param mat_x: List of solutions in lines and dimensions in columns.
+    :type mat_x: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param n_inducing: Number of inducing points m.
+    :type n_inducing: int
+    :param method: 'greedy' or 'kmeans++'.
+    :type method: str
+    :param random_state: Seed or source of randomness of k-means++.
+    :type random_state: np.random.RandomState
+    :return: Indices of the selected solutions.
+    :rtype: np.array """
+    if method not in SELECTION_METHODS:
+        raise ValueError("Unknown selection method: {}".format(method))
+
+    util = bolib.models.gp.kernels.util
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    mat_x = np.asarray(mat_x, dtype=np.float64)
+    n_inducing = min(n_inducing, mat_x.shape[0])
+    chosen = []
+    if method == 'greedy':
+        residual = kernel.kernel_diag(mat_x, lengthscale).copy()
+        factor = np.zeros((n_inducing, mat_x.shape[0]))
+        for step in range(n_inducing):
+            pivot = int(np.argmax(residual))
+            if residual[pivot] <= 0.0:
+                break
+            chosen.append(pivot)
+            column = np.asarray(kernel.kernel_function(
+                mat_x[pivot:pivot + 1], mat_x, lengthscale)).ravel()
+            if profile:
+                stamp = profiling.clock()
+            column -= np.dot(factor[:step, pivot], factor[:step])
+            factor[step] = column / np.sqrt(residual[pivot])
+            residual -= np.square(factor[step])
+            residual[chosen] = 0.0
+            if profile:
+                profiling.record(profiling.kernel_name(kernel), 'solve',
+                                 stamp)
+    else:
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        if profile:
+            stamp = profiling.clock()
+        scaled = util.scale(mat_x, lengthscale)
+        sq_norms = util.sq_norm(scaled)
+        closest = np.full(mat_x.shape[0], np.inf)
+        pivot = random_state.randint(mat_x.shape[0])
+        for _ in range(n_inducing):
+            chosen.append(pivot)
+            np.minimum(closest, util.scaled_sq_distance(
+                scaled[pivot:pivot + 1], scaled,
+                sq_norm_a=sq_norms[pivot:pivot + 1],
+                sq_norm_b=sq_norms)[0], out=closest)
+            closest[chosen] = 0.0
+            total = closest.sum()
+            if total <= 0.0:
+                break
+            pivot = random_state.choice(mat_x.shape[0], p=closest / total)
+        if profile:
+            profiling.record(profiling.kernel_name(kernel), 'distance',
+                             stamp, (scaled, closest))
+
+    return np.array(chosen, dtype=int)
+
+
+class Nystroem(object):
+    """ Low-rank approximation K_xz K_zz^-1 K_zx of the kernel matrix
+    through m inducing points Z.
+
+    The Cholesky factor of K_zz is cached and refactorized only when the
+    lengthscale changes, so that every product costs O(n m^2) instead of
+    the O(n^3) of the exact kernel matrix. """
+
+    def __init__(self, kernel, mat_z, jitter=1e-10):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param mat_z: List of inducing points in lines and dimensions in
+         columns, e.g. selected with select_inducing.
+        :type mat_z: np.array
+        :param jitter: Value added to the diagonal of K_zz, relative to its
+         mean, to keep it positive definite.
+        :type jitter: float
+        """
+        self.kernel = kernel
+        self.mat_z = np.asarray(mat_z, dtype=np.float64)
+        self.jitter = jitter
+        self.key = None
+        self._factor = None
+
+    def factor(self, lengthscale):
+        """ Cholesky factor of K_zz, factorized only when the lengthscale
+        changes.
+
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Factor and lower flag, as returned by
+         scipy.linalg.cho_factor.
+        :rtype: tuple """
+        key = np.asarray(lengthscale, dtype=np.float64).tobytes()
+        if key != self.key:
+            k_zz = np.array(self.kernel.kernel_function(
+                self.mat_z, self.mat_z, lengthscale))
+            stamp = self._start()
+            k_zz[np.diag_indices_from(k_zz)] += \
+                self.jitter * np.mean(np.diag(k_zz))
+            self._factor = scipy.linalg.cho_factor(k_zz, lower=True)
+            self.key = key
+            self._record('solve', stamp, (k_zz,))
+
+        return self._factor
+
+    def features(self, mat_x, lengthscale):
+        """ Measures the (n, m) features K_xz L^-T, with L the Cholesky
+        factor of K_zz, whose inner products are the approximate kernel
+        matrix.
+
+        :param mat_x: List of solutions in lines and dimensions in columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Features, one line per solution.
+        :rtype: np.array """
+        chol, lower = self.factor(lengthscale)
+        k_zx = np.asarray(self.kernel.kernel_function(
+            self.mat_z, mat_x, lengthscale))
+        stamp = self._start()
+        result = scipy.linalg.solve_triangular(chol, k_zx, lower=lower).T
+        self._record('solve', stamp, (result,))
+
+        return result
+
+    def kernel_function(self, mat_a, mat_b, lengthscale):
+        """ Approximates the kernel matrix between solutions of A and B.
+
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: Approximate kernel matrix.
+        :rtype: np.array """
+        features_a = self.features(mat_a, lengthscale)
+        features_b = features_a if mat_b is mat_a else \
+            self.features(mat_b, lengthscale)
+
+        return np.dot(features_a, features_b.T)
+
+    def dk_dx(self, mat_a, mat_b, lengthscale):
+        """ Measures gradient of the approximate kernel function in the
+        solutions of A, dK_az K_zz^-1 K_zb, in O(n m d) per column.
+
+        :param mat_a: List of solutions in lines and dimensions in columns.
+        :type mat_a: np.array
+        :param mat_b: List of solutions in lines and dimensions in columns.
+        :type mat_b: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: 3D array with the gradient of the kernel function in every
+         dimension of X.
+        :rtype: np.array """
+        factor = self.factor(lengthscale)
+        k_zb = np.asarray(self.kernel.kernel_function(
+            self.mat_z, mat_b, lengthscale))
+        stamp = self._start()
+        weights = scipy.linalg.cho_solve(factor, k_zb)
+        self._record('solve', stamp, (weights,))
+        grad_az = self.kernel.dk_dx(mat_a, self.mat_z, lengthscale)
+        stamp = self._start()
+        result = np.einsum('azd,zb->abd', grad_az, weights)
+        self._record('gradient', stamp, (result,))
+
+        return result
+
+    def gradient_factors(self, mat_x, lengthscale):
+        """ Measures the low-rank factors of the gradient of the
+        approximate kernel matrix between solutions of X and themselves in
+        the length-scale hyper-parameter space.
+
+        With A = K_xz K_zz^-1, the gradient in the d-th lengthscale is
+        B_d A^T + A B_d^T, with B_d = dK_xz - A dK_zz / 2, so that traces
+        and products with it cost O(n m) per dimension.
+
+        :param mat_x: List of solutions in lines and dimensions in columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: (n, m) array A and (d, n, m) array of the B_d.
+        :rtype: tuple """
+        factor = self.factor(lengthscale)
+        k_zx = np.asarray(self.kernel.kernel_function(
+            self.mat_z, mat_x, lengthscale))
+        stamp = self._start()
+        weights = scipy.linalg.cho_solve(factor, k_zx).T
+        self._record('solve', stamp, (weights,))
+        grad_xz = np.moveaxis(
+            self.kernel.dk_dl(mat_x, self.mat_z, lengthscale), -1, 0)
+        grad_zz = np.moveaxis(
+            self.kernel.dk_dl(self.mat_z, self.mat_z, lengthscale), -1, 0)
+        stamp = self._start()
+        factors = grad_xz - 0.5 * np.matmul(weights, grad_zz)
+        self._record('gradient', stamp, (factors,))
+
+        return weights, factors
+
+    def dk_dl(self, mat_x, lengthscale):
+        """ Measures gradient of the approximate kernel matrix between
+        solutions of X and themselves in the length-scale hyper-parameter
+        space, expanding its low-rank factors (see gradient_factors).
+
+        :param mat_x: List of solutions in lines and dimensions in columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        :return: 3D array with the gradient of the kernel function in every
+         dimension the length-scale hyper-parameter space.
+        :rtype: np.array """
+        weights, factors = self.gradient_factors(mat_x, lengthscale)
+        stamp = self._start()
+        half = np.einsum('dnz,mz->nmd', factors, weights)
+        result = half + np.swapaxes(half, 0, 1)
+        self._record('gradient', stamp, (half, result))
+
+        return result
+
+    def _start(self):
+        """ Clock to record a stage from, None while no profile is
+        active. """
+        if bolib.models.gp.kernels.profiling.ENABLED:
+            return bolib.models.gp.kernels.profiling.clock()
+
+        return None
+
+    def _record(self, stage, stamp, arrays):
+        """ Records a stage of the approximation under its kernel, if it
+        was started while a profile was active. """
+        if stamp is not None:
+            profiling = bolib.models.gp.kernels.profiling
+            profiling.record(profiling.kernel_name(self.kernel), stage,
+                             stamp, arrays)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import bolib.models.gp.kernels.profiling
+import bolib.models.gp.kernels.util
+
+PREPARED_OUTPUTS = ('k', 'dx')
+
+
+class PreparedKernel(object):
+    """ Kernel bound to a fixed set of training solutions and lengthscale,
+    for repeated queries of a few solutions against them.
+
+    The training solutions divided by the lengthscale and their squared
+    norms are computed once, so a query only scales its own solutions and
+    measures a (n, N) distance matrix. Subclasses, one per kernel module,
+    set stationary_terms. """
+
+    __slots__ = ('mat_x', 'lengthscale', 'scaled', 'sq_norm',
+                 '_inv_lengthscale')
+
+    stationary_terms = None
+
+    def __init__(self, mat_x, lengthscale):
+        """
+        :param mat_x: List of training solutions in lines and dimensions in
+         columns.
+        :type mat_x: np.array
+        :param lengthscale: Array of lenghtscale parameters. One per
+         dimension in ARD case, only one element otherwise.
+        :type lengthscale: np.array
+        """
+        util = bolib.models.gp.kernels.util
+        self.mat_x = np.array(mat_x, dtype=np.float64)
+        self.lengthscale = np.array(np.broadcast_to(
+            util.as_lengthscale(lengthscale, stacked=False),
+            self.mat_x.shape[-1:]))
+        self._inv_lengthscale = 1.0 / self.lengthscale
+        self.scaled = self.mat_x * self._inv_lengthscale
+        self.sq_norm = util.sq_norm(self.scaled)
+
+    def kernel_function(self, mat_a):
+        """ Measures the kernel matrix between the solutions of A and the
+        training solutions.
+
+        :param mat_a: A solution, or a list of solutions in lines and
+         dimensions in columns.
+        :type mat_a: np.array
+        :return: (n, N) kernel matrix.
+        :rtype: np.array """
+        return self.evaluate(mat_a, want=('k',))[0]
+
+    def dk_dx(self, mat_a):
+        """ Measures gradient of the kernel function between the solutions
+        of A and the training solutions in the solutions of A.
+
+        :param mat_a: A solution, or a list of solutions in lines and
+         dimensions in columns.
+        :type mat_a: np.array
+        :return: (n, N, d) gradient of the kernel function in every
+         dimension of X.
+        :rtype: np.array """
+        return self.evaluate(mat_a, want=('dx',))[0]
+
+    def evaluate(self, mat_a, want=PREPARED_OUTPUTS):
+        """ Measures the kernel function and its gradient in the solutions of
+        A at once, sharing the distance matrix among them.
+
+        :param mat_a: A solution, or a list of solutions in lines and
+         dimensions in columns.
+        :type mat_a: np.array
+        :param want: Requested outputs: 'k' and/or 'dx'.
+        :type want: tuple
+        :return: Requested outputs, in the same order as in want.
+        :rtype: tuple """
+        unknown = [name for name in want if name not in PREPARED_OUTPUTS]
+        if unknown:
+            raise ValueError(
+                "Unknown prepared kernel outputs: {}".format(unknown))
+
+        profiling = bolib.models.gp.kernels.profiling
+        profile = profiling.ENABLED
+        scaled_a = np.asarray(mat_a, dtype=np.float64).reshape(
+            -1, self.scaled.shape[1]) * self._inv_lengthscale
+        if profile:
+            kernel = profiling.kernel_name(self.stationary_terms)
+            profiling.count(kernel, want, scaled_a.shape, self.scaled.shape)
+            stamp = profiling.clock()
+        sq_dist = bolib.models.gp.kernels.util.scaled_sq_distance(
+            scaled_a, self.scaled, sq_norm_b=self.sq_norm)
+        if profile:
+            stamp = profiling.record(kernel, 'distance', stamp, (sq_dist,))
+        value, grad_r2 = self.stationary_terms(
+            sq_dist, value='k' in want, gradient='dx' in want,
+            overwrite=True)
+        if profile:
+            stamp = profiling.record(kernel, 'elementwise', stamp,
+                                     (value, grad_r2), reuse=sq_dist)
+
+        results = {'k': value}
+        if 'dx' in want:
+            # dr^2/dx = 2 (a - x) / l^2, from the scaled solutions
+            grad_x = scaled_a[:, np.newaxis, :] - self.scaled
+            grad_x *= 2.0 * self._inv_lengthscale
+            grad_x *= grad_r2[..., np.newaxis]
+            results['dx'] = grad_x
+            if profile:
+                profiling.record(kernel, 'gradient', stamp, (grad_x,))
+
+        return tuple(results[name] for name in want)
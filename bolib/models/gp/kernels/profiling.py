@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import threading
+import timeit
+import types
+
+STAGES = ('distance', 'elementwise', 'gradient', 'fused', 'solve', 'cache')
+
+# Checked by util before measuring anything, so that the instrumentation
+# costs a single attribute lookup per stage while no Profile is active.
+ENABLED = False
+
+_ACTIVE = []
+
+_LOCK = threading.Lock()
+
+clock = timeit.default_timer
+
+
+class Profile(object):
+    """ Opt-in instrumentation of the kernel evaluations, as a context
+    manager.
+
+    While it is active, every kernel evaluation, through util.evaluate or
+    through the prepared, incremental, cached, compact, low-rank and
+    matrix-free paths, counts a call of its kernel, with the requested
+    outputs and the shapes of the solutions. Every stage of it records its
+    wall time and the bytes of the arrays it produces: the distance matrix,
+    the element-wise kernel terms, the gradients, the fused loop of the
+    compiled backend, the linear algebra of the approximations ('solve')
+    and the reads and writes of the on-disk cache ('cache'). Work that does
+    not depend on a kernel, such as distance bases, is recorded under the
+    name of its module. Profiles may be nested. ::
+
+        with profiling.Profile() as profile:
+            matern52.evaluate(mat_a, mat_b, lengthscale)
+        profile.to_json('profile.json')
+    """
+
+    def __init__(self, callback=None):
+        """
+        :param callback: Optional function called with the report when the
+         profile is exited.
+        :type callback: function
+        """
+        self.callback = callback
+        self.kernels = {}
+
+    def __enter__(self):
+        global ENABLED
+        with _LOCK:
+            _ACTIVE.append(self)
+            ENABLED = True
+
+        return self
+
+    def __exit__(self, *exc_info):
+        global ENABLED
+        with _LOCK:
+            _ACTIVE.remove(self)
+            ENABLED = bool(_ACTIVE)
+        if self.callback is not None:
+            self.callback(self.report())
+
+        return False
+
+    def _kernel(self, kernel):
+        """ Records of a kernel, created on first use. """
+        if kernel not in self.kernels:
+            self.kernels[kernel] = {
+                'calls': 0,
+                'outputs': {},
+                'shapes': {},
+                'stages': dict(
+                    (stage, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                    for stage in STAGES),
+            }
+
+        return self.kernels[kernel]
+
+    def report(self):
+        """ Records of every kernel.
+
+        :return: Calls, requested outputs and shapes counted per kernel,
+         with the count, wall time and bytes allocated of every stage.
+        :rtype: dict """
+        with _LOCK:
+            return json.loads(json.dumps(self.kernels))
+
+    def to_json(self, path=None):
+        """ Exports the report as JSON.
+
+        :param path: Optional file to write the report in.
+        :type path: str
+        :return: Report as a JSON string.
+        :rtype: str """
+        text = json.dumps(self.report(), indent=1, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as output:
+                output.write(text)
+
+        return text
+
+
+def kernel_name(kernel):
+    """ Name a kernel is recorded under.
+
+    :param kernel: Kernel module, or one of its functions.
+    :type kernel: module
+    :return: Name of the module, without its package.
+    :rtype: str """
+    if isinstance(kernel, types.ModuleType):
+        name = kernel.__name__
+    else:
+        name = kernel.__module__
+
+    return name.rsplit('.', 1)[-1]
+
+
+def count(kernel, want, *shapes):
+    """ Counts a call of a kernel in every active profile.
+
+    :param kernel: Name of the kernel.
+    :type kernel: str
+    :param want: Requested outputs.
+    :type want: tuple
+    :param shapes: Shapes of the solutions.
+    :type shapes: tuple
+    """
+    outputs = ','.join(want)
+    shapes = ' x '.join(str(tuple(shape)) for shape in shapes)
+    with _LOCK:
+        for profile in _ACTIVE:
+            records = profile._kernel(kernel)
+            records['calls'] += 1
+            records['outputs'][outputs] = \
+                records['outputs'].get(outputs, 0) + 1
+            records['shapes'][shapes] = records['shapes'].get(shapes, 0) + 1
+
+
+def record(kernel, stage, start, arrays=(), reuse=None):
+    """ Records a stage of a kernel evaluation in every active profile.
+
+    :param kernel: Name of the kernel.
+    :type kernel: str
+    :param stage: One of STAGES.
+    :type stage: str
+    :param start: Clock when the stage started.
+    :type start: float
+    :param arrays: Arrays produced by the stage, whose bytes estimate its
+     allocations. None entries are ignored.
+    :type arrays: tuple
+    :param reuse: Work buffer of the stage, or tuple of them, not counted
+     among its arrays.
+    :type reuse: np.array
+    :return: Clock when the stage ended, to start the next one with.
+    :rtype: float """
+    end = clock()
+    reuse = reuse if isinstance(reuse, tuple) else (reuse,)
+    n_bytes = sum(array.nbytes for array in arrays if array is not None and
+                  not any(array is buffer for buffer in reuse))
+    with _LOCK:
+        for profile in _ACTIVE:
+            records = profile._kernel(kernel)['stages'][stage]
+            records['count'] += 1
+            records['seconds'] += end - start
+            records['bytes'] += n_bytes
+
+    return end
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import scipy.linalg
+
+
+def regular_spacing(mat_x, rtol=1e-8):
+    """ Detects whether the 1-D solutions are equally spaced in increasing
+    order.
+
+    :param mat_x: List of 1-D solutions, in lines.
+    :type mat_x: np.array
+    :param rtol: Tolerance of the spacing, relative to the mean one.
+    :type rtol: float
+    :return: Spacing of the solutions, or None if they are not equally
+     spaced or not 1-D.
+    :rtype: float """
+    mat_x = np.asarray(mat_x, dtype=np.float64)
+    if mat_x.ndim != 2 or mat_x.shape[1] != 1 or mat_x.shape[0] < 2:
+        return None
+
+    steps = np.diff(mat_x[:, 0])
+    step = np.mean(steps)
+    if step <= 0.0 or np.max(np.abs(steps - step)) > rtol * step:
+        return None
+
+    return step
+
+
+class ToeplitzGram(object):
+    """ Kernel matrix between equally spaced 1-D solutions and themselves.
+
+    The kernel matrix of a stationary kernel on a regular 1-D grid is a
+    symmetric Toeplitz matrix, so only its first column is kept. Products
+    with it cost O(n log n), through the FFT of its circulant embedding,
+    and systems are solved by Levinson recursion in O(n^2). """
+
+    def __init__(self, kernel, mat_x, lengthscale):
+        """
+        :param kernel: Kernel module, e.g.
+         bolib.models.gp.kernels.matern52.
+        :type kernel: module
+        :param mat_x: List of equally spaced 1-D solutions, in lines.
+        :type mat_x: np.array
+        :param lengthscale: Array with the lenghtscale parameter.
+        :type lengthscale: np.array
+        """
+        mat_x = np.asarray(mat_x, dtype=np.float64)
+        if mat_x.shape[0] > 1 and regular_spacing(mat_x) is None:
+            raise ValueError("Solutions are not equally spaced 1-D points")
+
+        self.kernel = kernel
+        self.column = np.asarray(kernel.kernel_function(
+            mat_x[:1], mat_x, lengthscale)).ravel()
+        self._spectrum = None
+
+    @property
+    def shape(self):
+        """ Shape of the full kernel matrix. """
+        return self.column.shape[0], self.column.shape[0]
+
+    def dense(self):
+        """ Full kernel matrix.
+
+        :return: Kernel matrix.
+        :rtype: np.array """
+        return scipy.linalg.toeplitz(self.column)
+
+    def matvec(self, vec):
+        """ Product of the kernel matrix with a vector or with the columns
+        of a matrix, through the FFT of its circulant embedding.
+
+        :param vec: (n,) vector or (n, k) matrix.
+        :type vec: np.array
+        :return: Product, with the shape of vec.
+        :rtype: np.array """
+        vec = np.asarray(vec, dtype=np.float64)
+        size = self.column.shape[0]
+        if size < 2:
+            return self.column[0] * vec
+        if self._spectrum is None:
+            # first column of the (2n - 2) circulant matrix embedding K
+            self._spectrum = np.fft.rfft(np.concatenate(
+                [self.column, self.column[-2:0:-1]]))
+
+        spectrum = self._spectrum.reshape((-1,) + (1,) * (vec.ndim - 1))
+        result = np.fft.irfft(
+            np.fft.rfft(vec, n=2 * size - 2, axis=0) * spectrum,
+            n=2 * size - 2, axis=0)
+
+        return result[:size]
+
+    def solve(self, vec, noise=0.0):
+        """ Solves (K + noise I) x = vec by Levinson recursion.
+
+        :param vec: (n,) vector or (n, k) matrix.
+        :type vec: np.array
+        :param noise: Variance added to the diagonal.
+        :type noise: float
+        :return: Solution, with the shape of vec.
+        :rtype: np.array """
+        column = self.column.copy()
+        column[0] += noise
+
+        return scipy.linalg.solve_toeplitz(column, vec)
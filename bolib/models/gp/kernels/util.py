@@ -17,8 +17,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+import threading
+
 import numpy as np
 
+import bolib.models.gp.kernels.jit
+import bolib.models.gp.kernels.profiling
+
 
 def sq_distance(mat_a, mat_b, lengthscale):
     """ Measures the distance matrix between solutions of A and B.
@@ -32,15 +42,246 @@ def sq_distance(mat_a, mat_b, lengthscale):
     :type lengthscale: np.array
     :return: Distance matrix between solutions of A and B.
     :rtype: np.matrix """
-    mat_a = mat_a / lengthscale
-    mat_b = mat_b / lengthscale
-    result = np.sum(np.power(mat_a, 2.0), axis=1) + \
-        np.sum(np.power(mat_b, 2.0), axis=1).T - 2 * np.dot(mat_a, mat_b.T)
+    return as_matrix(sq_distance_array(
+        mat_a, mat_b, as_lengthscale(lengthscale, stacked=False)))
+
+
+def sq_distance_array(mat_a, mat_b, lengthscale, dtype=np.float64):
+    """ Measures the distance matrix between solutions of A and B, working on
+    plain arrays.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: C-contiguous distance matrix between solutions of A and B.
+    :rtype: np.array """
+    if _compiled(mat_a, mat_b, lengthscale, dtype):
+        return bolib.models.gp.kernels.jit.sq_distance(
+            np.asarray(mat_a, dtype=np.float64),
+            np.asarray(mat_b, dtype=np.float64),
+            as_lengthscale(lengthscale), dtype=dtype)
+
+    return scaled_sq_distance(scale(mat_a, lengthscale, dtype),
+                              scale(mat_b, lengthscale, dtype))
+
+
+def scaled_sq_distance(scaled_a, scaled_b, sq_norm_a=None, sq_norm_b=None,
+                       out=None):
+    """ Measures the distance matrix between solutions of A and B already
+    divided by the lenghtscale, reusing their squared norms when they are
+    known.
+
+    :param scaled_a: Solutions of A divided by the lenghtscale.
+    :type scaled_a: np.array
+    :param scaled_b: Solutions of B divided by the lenghtscale.
+    :type scaled_b: np.array
+    :param sq_norm_a: Squared norms of the solutions of A, if known.
+    :type sq_norm_a: np.array
+    :param sq_norm_b: Squared norms of the solutions of B, if known.
+    :type sq_norm_b: np.array
+    :param out: Optional buffer to store the result in.
+    :type out: np.array
+    :return: C-contiguous distance matrix between solutions of A and B.
+    :rtype: np.array """
+    if sq_norm_a is None:
+        sq_norm_a = sq_norm(scaled_a)
+    if sq_norm_b is None:
+        sq_norm_b = sq_norm(scaled_b)
+
+    result = np.matmul(scaled_a, np.swapaxes(scaled_b, -1, -2), out=out)
+    result *= -2.0
+    result += sq_norm_a[..., :, np.newaxis]
+    result += sq_norm_b[..., np.newaxis, :]
+
+    return np.maximum(result, 0.0, out=result)
+
+
+MIXED = 'mixed'
+
+MIXED_RTOL = 1e-4
+
+UNIT_ROUNDOFF_32 = np.finfo(np.float32).eps / 2.0
+
+
+def sq_distance_mixed(mat_a, mat_b, lengthscale, rtol=MIXED_RTOL):
+    """ Measures the distance matrix between solutions of A and B in single
+    precision, recomputing in double precision the distances whose error
+    bound (see mixed_error_bound) exceeds rtol times their value. Those are
+    the near-zero distances, where the expansion
+    |a|^2 + |b|^2 - 2 a b cancels catastrophically.
+
+    The result satisfies |r2' - r2| <= (rtol + u) r2, where u is the unit
+    roundoff of single precision, 2^-24.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param rtol: Relative error allowed in the single precision distances.
+    :type rtol: float
+    :return: Single precision distance matrix between solutions of A and B.
+    :rtype: np.array """
+    scaled_a = scale(mat_a, lengthscale, np.float32)
+    scaled_b = scale(mat_b, lengthscale, np.float32)
+    sq_norm_a, sq_norm_b = sq_norm(scaled_a), sq_norm(scaled_b)
+    result = scaled_sq_distance(scaled_a, scaled_b, sq_norm_a, sq_norm_b)
+
+    index = np.nonzero(mixed_error_bound(
+        sq_norm_a, sq_norm_b, scaled_a.shape[-1]) > rtol * result)
+    if index[0].size:
+        shape = result.shape + scaled_a.shape[-1:]
+        pairs_a = np.broadcast_to(scale(
+            mat_a, lengthscale)[..., :, np.newaxis, :], shape)[index]
+        pairs_b = np.broadcast_to(scale(
+            mat_b, lengthscale)[..., np.newaxis, :, :], shape)[index]
+        result[index] = sq_norm(pairs_a - pairs_b)
+
+    return result
+
+
+def mixed_error_bound(sq_norm_a, sq_norm_b, n_dims):
+    """ Bound on the absolute error of the single precision distances
+    measured through the expansion |a|^2 + |b|^2 - 2 a b, from the error
+    analysis of dot products: gamma_(d+3) (|a|^2 + |b|^2), with
+    gamma_k = k u / (1 - k u).
+
+    :param sq_norm_a: Squared norms of the scaled solutions of A.
+    :type sq_norm_a: np.array
+    :param sq_norm_b: Squared norms of the scaled solutions of B.
+    :type sq_norm_b: np.array
+    :param n_dims: Number of dimensions of the solutions.
+    :type n_dims: int
+    :return: Bound on the absolute error of every distance.
+    :rtype: np.array """
+    steps = (n_dims + 3) * UNIT_ROUNDOFF_32
+    gamma = steps / (1.0 - steps)
+
+    return gamma * (np.asarray(sq_norm_a)[..., :, np.newaxis] +
+                    np.asarray(sq_norm_b)[..., np.newaxis, :])
+
+
+def sq_distance_symmetric(mat_a, lengthscale, dtype=np.float64):
+    """ Measures the distance matrix between every pair of solutions of A.
+    The cross products are obtained with a single symmetric rank-k update,
+    the result is exactly symmetric and its diagonal is exactly zero.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: C-contiguous symmetric distance matrix between solutions of A.
+    :rtype: np.array """
+    mat_a = scale(mat_a, lengthscale, dtype)
+    norms = sq_norm(mat_a)
+
+    # A A^T is dispatched to syrk, adding the norms before subtracting it
+    # keeps every operation commutative and the result exactly symmetric.
+    result = norms[..., :, np.newaxis] + norms[..., np.newaxis, :]
+    result -= 2.0 * np.matmul(mat_a, np.swapaxes(mat_a, -1, -2))
+    np.maximum(result, 0.0, out=result)
+    diagonal = np.arange(mat_a.shape[-2])
+    result[..., diagonal, diagonal] = 0.0
+
+    return result
+
 
-    return result.clip(min=0.0)
+PACKED_BLOCKS = 8
+
+
+def sq_distance_packed(mat_a, lengthscale, dtype=np.float64):
+    """ Measures the upper triangle of the distance matrix between every pair
+    of solutions of A, packed row by row as in pack_upper, without ever
+    holding the full matrix. The rows are measured in PACKED_BLOCKS blocks,
+    each one against the solutions from its first row onwards, so that the
+    intermediate arrays stay within a fraction of the packed triangle. The
+    diagonal is exactly zero.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: Packed upper triangle, with n (n + 1) / 2 elements.
+    :rtype: np.array """
+    mat_a = scale(mat_a, lengthscale, dtype)
+    norms = sq_norm(mat_a)
+    size = mat_a.shape[-2]
+    result = np.empty(mat_a.shape[:-2] + (size * (size + 1) // 2,),
+                      dtype=dtype)
 
+    step = max(1, -(-size // PACKED_BLOCKS))
+    offset = 0
+    for start in range(0, size, step):
+        stop = min(start + step, size)
+        block = _sq_distance_panel(mat_a, norms, start, stop)
+        for row in range(stop - start):
+            length = size - start - row
+            result[..., offset:offset + length] = block[..., row, row:]
+            offset += length
 
-def dr_dx(mat_a, mat_b, lengthscale):
+    return result
+
+
+def _sq_distance_panel(scaled, norms, start, stop):
+    """ Distances between the scaled solutions from start to stop and the
+    ones from start onwards, a panel of rows of the upper triangle, with an
+    exactly zero diagonal. """
+    block = np.matmul(scaled[..., start:stop, :],
+                      np.swapaxes(scaled[..., start:, :], -1, -2))
+    block *= -2.0
+    block += norms[..., start:stop, np.newaxis]
+    block += norms[..., np.newaxis, start:]
+    np.maximum(block, 0.0, out=block)
+    rows = np.arange(stop - start)
+    block[..., rows, rows] = 0.0
+
+    return block
+
+
+def scale(mat, lengthscale, dtype=np.float64):
+    """ Divides the solutions by the lenghtscale.
+
+    :param mat: List of solutions in lines and dimensions in columns.
+    :type mat: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: C-contiguous solutions divided by the lenghtscale.
+    :rtype: np.array """
+    lengthscale = as_lengthscale(lengthscale, dtype)
+
+    return np.asarray(mat, dtype=dtype) / lengthscale[..., np.newaxis, :]
+
+
+def sq_norm(mat):
+    """ Measures the squared norm of every solution.
+
+    :param mat: List of solutions in lines and dimensions in columns.
+    :type mat: np.array
+    :return: Squared norm of every solution.
+    :rtype: np.array """
+    return np.einsum('...ij,...ij->...i', mat, mat)
+
+
+def dr_dx(mat_a, mat_b, lengthscale, out=None, dtype=np.float64,
+          stacked=False):
     """ 
     Measures gradient of the distance between solutions of A and B in X.
     
@@ -49,23 +290,33 @@ def dr_dx(mat_a, mat_b, lengthscale):
     :param mat_b: List of solutions in lines and dimensions in columns.
     :type mat_b: np.matrix
     :param lengthscale: Array of lenghtscale parameters. One per dimension
-     in ARD case, only one element otherwise.  
+     in ARD case, only one element otherwise. A (L, d) array with L > 1
+     stacks L lengthscales, adding a leading dimension of size L to the
+     results, and so does a single row one if stacked.
     :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :param stacked: Whether a single row lengthscale is a stack of one.
+    :type stacked: bool
     :return: 3D array with the gradient in every dimension of X.
     :rtype: np.array """
-    mat_a = mat_a
-    mat_b = mat_b
+    lengthscale = as_lengthscale(lengthscale, dtype, stacked)
+    if _compiled(mat_a, mat_b, lengthscale, dtype):
+        return bolib.models.gp.kernels.jit.dr_dx(
+            np.asarray(mat_a, dtype=np.float64),
+            np.asarray(mat_b, dtype=np.float64), lengthscale, out=out,
+            dtype=dtype)
 
-    result = np.zeros((mat_a.shape[0], mat_b.shape[0], mat_a.shape[1]))
-
-    for i in range(0, mat_a.shape[0]):
-        result[i, :, :] = 2.0 * (mat_a[i, :] - mat_b[:, :]) /\
-            np.power(lengthscale, 2.0)
+    result = _difference(mat_a, mat_b, lengthscale, out, dtype)
+    result *= 2.0 / np.power(lengthscale, 2.0)[..., np.newaxis, np.newaxis, :]
 
     return result
 
 
-def dr_dl(mat_a, mat_b, lengthscale):
+def dr_dl(mat_a, mat_b, lengthscale, out=None, dtype=np.float64,
+          stacked=False):
     """ 
     Measures gradient of the distance between solutions of A and B in the
     length-scale hyper-parameter space.
@@ -75,18 +326,822 @@ def dr_dl(mat_a, mat_b, lengthscale):
     :param mat_b: List of solutions in lines and dimensions in columns.
     :type mat_b: np.matrix
     :param lengthscale: Array of lenghtscale parameters. One per dimension
-     in ARD case, only one element otherwise.  
+     in ARD case, only one element otherwise. A (L, d) array with L > 1
+     stacks L lengthscales, adding a leading dimension of size L to the
+     results, and so does a single row one if stacked.
     :type lengthscale: np.array
+    :param out: Optional buffer of shape (n, m, d) to store the result in.
+    :type out: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :param stacked: Whether a single row lengthscale is a stack of one.
+    :type stacked: bool
     :return: 3D array with the gradient in every
      dimension the length-scale hyper-parameter space.
     :rtype: np.array """
-    mat_a = mat_a
-    mat_b = mat_b
+    lengthscale = as_lengthscale(lengthscale, dtype, stacked)
+    if _compiled(mat_a, mat_b, lengthscale, dtype):
+        return bolib.models.gp.kernels.jit.dr_dl(
+            np.asarray(mat_a, dtype=np.float64),
+            np.asarray(mat_b, dtype=np.float64), lengthscale, out=out,
+            dtype=dtype)
+
+    result = _difference(mat_a, mat_b, lengthscale, out, dtype)
+    np.square(result, out=result)
+    result *= -2.0 / np.power(lengthscale, 3.0)[..., np.newaxis, np.newaxis, :]
+
+    return result
+
+
+def _difference(mat_a, mat_b, lengthscale, out=None, dtype=np.float64):
+    """ Broadcasts the difference between every solution of A and B into a
+    (n, m, d) array, with the batch dimensions of the lengthscale too,
+    written into out when it is given. """
+    mat_a = np.asarray(mat_a, dtype=dtype)[..., :, np.newaxis, :]
+    mat_b = np.asarray(mat_b, dtype=dtype)[..., np.newaxis, :, :]
+    if out is None:
+        out = np.empty(np.broadcast(
+            mat_a, mat_b, lengthscale[..., np.newaxis, np.newaxis, :]).shape,
+                       dtype=dtype)
+
+    return np.subtract(mat_a, mat_b, out=out)
+
+
+def as_lengthscale(lengthscale, dtype=np.float64, stacked=True):
+    """ Lenghtscale parameters as a plain array whose last dimension
+    matches the dimensions of the solutions. Leading dimensions of plain
+    arrays stack several lengthscales, even a single one, as in a (1, d)
+    array, unless stacked is False. A single row np.matrix is always one
+    lengthscale and is flattened.
+
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the result.
+    :type dtype: np.dtype
+    :param stacked: Whether a single row array is a stack of one
+     lengthscale. The matrix API, whose lengthscales are row vectors, sets
+     it to False.
+    :type stacked: bool
+    :return: Plain array of lenghtscale parameters.
+    :rtype: np.array """
+    single = np.ndim(lengthscale) == 2 and np.shape(lengthscale)[0] == 1 \
+        and (not stacked or isinstance(lengthscale, np.matrix))
+    lengthscale = np.asarray(lengthscale, dtype=dtype)
+    if lengthscale.ndim == 0 or single:
+        lengthscale = lengthscale.ravel()
+
+    return lengthscale
+
+
+def _compiled(mat_a, mat_b, lengthscale, dtype):
+    """ Whether the compiled backend is enabled and handles the
+    evaluation: plain lists of solutions, a single lengthscale and double
+    precision, which the fused loops compute in. """
+    jit = bolib.models.gp.kernels.jit
+    return jit.ENABLED and jit.available() and not _is_mixed(dtype) \
+        and np.dtype(dtype) == np.float64 \
+        and np.ndim(mat_a) == 2 and np.ndim(mat_b) == 2 \
+        and as_lengthscale(lengthscale).ndim <= 1
+
+
+def _broadcast_shape(*shapes):
+    """ Shape the given shapes broadcast to. """
+    return np.broadcast(
+        *[np.empty(tuple(shape) + (0,)) for shape in shapes + ((),)]
+    ).shape[:-1]
+
+
+OUTPUTS = ('k', 'dx', 'dl')
+
+MAX_BYTES = 256 * 2 ** 20
+
+
+def evaluate(stationary_terms, mat_a, mat_b, lengthscale,
+             want=OUTPUTS, out=None, dtype=np.float64, packed=False,
+             max_bytes=None, n_jobs=1, executor=None, mask_a=None,
+             mask_b=None, scalar_terms=None):
+    """
+    Measures the kernel function and its gradients between solutions of A
+    and B, sharing a single distance computation among all of them.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivative with respect to the squared distance element-wise to the
+     distance matrix.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+     Leading dimensions, if any, stack independent lists of solutions and
+     broadcast with the ones of mat_b and lengthscale.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+     When it is None or mat_a itself, the symmetric self-covariance is
+     measured, applying the kernel function to the upper triangle only.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k' for the kernel matrix, 'dx' for its
+     gradient in X and 'dl' for its gradient in the length-scale
+     hyper-parameter space.
+    :type want: tuple
+    :param out: Optional buffers to store the outputs in, in the same order
+     as in want. None entries are allocated. Any writable array works,
+     np.memmap included.
+    :type out: tuple
+    :param dtype: Floating point type of the computation, or MIXED to
+     compute cross-covariances in single precision with the near-zero
+     distances in double precision (see sq_distance_mixed). Symmetric
+     evaluations, the ones to be factorized, stay in double precision.
+    :type dtype: np.dtype
+    :param packed: Whether to return the symmetric kernel matrix as its
+     packed upper triangle (see pack_upper). The distances are measured
+     straight into the triangle (see sq_distance_packed), so that no full
+     matrix is allocated.
+    :type packed: bool
+    :param max_bytes: When given, the outputs are computed in tiles of rows
+     of A whose intermediate arrays fit in this amount of bytes, and
+     written into out. Symmetric evaluations are computed in panels of
+     rows of the upper triangle, mirrored into the lower one, so that they
+     stay exactly symmetric.
+    :type max_bytes: int
+    :param n_jobs: Number of threads computing tiles of rows of A
+     concurrently, -1 for as many as processors. The results are identical
+     to the ones computed serially with the same tiles.
+    :type n_jobs: int
+    :param executor: Optional executor, with a map method, to compute the
+     tiles with instead of a thread pool of n_jobs threads.
+    :type executor: concurrent.futures.Executor
+    :param mask_a: Optional boolean mask of the valid solutions of A, as
+     returned by pad_batch. The outputs of padded solutions are zero.
+    :type mask_a: np.array
+    :param mask_b: Optional boolean mask of the valid solutions of B.
+    :type mask_b: np.array
+    :param scalar_terms: Optional function that returns the kernel function
+     and its derivative with respect to the squared distance of a single
+     distance. When it is given and the compiled backend is enabled (see
+     bolib.models.gp.kernels.jit), cross-covariances in double precision
+     are measured in a single fused loop over n_jobs threads. Symmetric,
+     packed, masked and single precision evaluations, and the ones with
+     max_bytes or an executor, keep to the NumPy backend.
+    :type scalar_terms: function
+    :return: Requested outputs as C-contiguous plain arrays, in the same
+     order as in want.
+    :rtype: tuple """
+    check_want(want)
+    symmetric = mat_b is None or mat_b is mat_a
+    n_jobs = effective_n_jobs(n_jobs)
+    tiled = max_bytes is not None or n_jobs > 1 or executor is not None
+    if packed and not symmetric:
+        raise ValueError("Packed output requires a symmetric evaluation")
+    if packed and tiled:
+        raise ValueError("Packed output can not be computed in tiles")
+    mat_a = np.asarray(mat_a)
+    mat_b = mat_a if symmetric else np.asarray(mat_b)
+    masks = (mask_a, mask_a if symmetric else mask_b)
+    dtype, out_dtype = _precision(dtype, symmetric)
+    buffers = list(out) if out is not None else [None] * len(want)
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    if profile:
+        kernel = profiling.kernel_name(stationary_terms)
+        profiling.count(kernel, want, mat_a.shape, mat_b.shape)
+        start = profiling.clock()
+
+    if scalar_terms is not None and not symmetric and max_bytes is None \
+            and executor is None and mask_a is None and mask_b is None and \
+            _compiled(mat_a, mat_b, lengthscale, dtype):
+        results = bolib.models.gp.kernels.jit.evaluate(
+            scalar_terms, np.asarray(mat_a, dtype=np.float64),
+            np.asarray(mat_b, dtype=np.float64), as_lengthscale(lengthscale),
+            want, buffers, dtype=out_dtype, n_jobs=n_jobs)
+        if profile:
+            profiling.record(kernel, 'fused', start, results)
+        return results
+
+    if not tiled and symmetric:
+        sq_dist = sq_distance_packed(mat_a, lengthscale, dtype)
+        if profile:
+            start = profiling.record(kernel, 'distance', start, (sq_dist,))
+        value, grad_r2 = stationary_terms(
+            sq_dist, value='k' in want, gradient=wants_gradient(want),
+            overwrite=True)
+        if value is not None and not packed:
+            value = unpack_upper(value)
+        if grad_r2 is not None:
+            grad_r2 = unpack_upper(grad_r2)
+        if profile:
+            start = profiling.record(kernel, 'elementwise', start,
+                                     (value, grad_r2), reuse=sq_dist)
+        results = _outputs(_mask(value, masks, packed),
+                           _mask(grad_r2, masks), mat_a, mat_b, lengthscale,
+                           want, buffers, dtype)
+        if profile:
+            profiling.record(kernel, 'gradient', start, _gradients(
+                results, want))
+        return results
+
+    if not tiled:
+        return evaluate_rows(stationary_terms, mat_a, mat_b, lengthscale,
+                             want, buffers, dtype, symmetric, masks=masks)
+
+    for index, name in enumerate(want):
+        if buffers[index] is None:
+            buffers[index] = np.empty(
+                _output_shape(mat_a, mat_b, lengthscale, name),
+                dtype=out_dtype)
+
+    if symmetric:
+        # the panels of sq_distance_packed, or smaller ones within
+        # max_bytes, mirrored into the lower triangle: the outputs are
+        # exactly symmetric and, without max_bytes, the same as the serial
+        # ones for any n_jobs
+        scaled = scale(mat_a, lengthscale, dtype)
+        norms = sq_norm(scaled)
+
+        def evaluate_panel(tile):
+            """ Evaluates a panel of rows into the buffers. """
+            _evaluate_panel(stationary_terms, scaled, norms, mat_a,
+                            lengthscale, want, buffers, dtype, tile[0],
+                            tile[1], masks)
+
+        panels = tile_rows(mat_a, mat_b, want, out_dtype,
+                           sys.maxsize if max_bytes is None else max_bytes,
+                           min_tiles=PACKED_BLOCKS, lengthscale=lengthscale)
+        map_tiles(evaluate_panel, panels, n_jobs, executor)
+
+        return tuple(buffers)
 
-    result = np.zeros((mat_a.shape[0], mat_b.shape[0], mat_a.shape[1]))
+    def evaluate_tile(tile):
+        """ Evaluates a tile of rows into its view of the buffers. """
+        start, stop = tile
+        evaluate_rows(stationary_terms, mat_a, mat_b, lengthscale, want,
+                      [_rows(buffer, name, start, stop)
+                       for name, buffer in zip(want, buffers)],
+                      dtype, symmetric, start, stop, masks)
+
+    tiles = tile_rows(mat_a, mat_b, want, out_dtype,
+                      MAX_BYTES if max_bytes is None else max_bytes,
+                      min_tiles=4 * n_jobs if n_jobs > 1 else 1,
+                      lengthscale=lengthscale)
+    map_tiles(evaluate_tile, tiles, n_jobs, executor)
+
+    return tuple(buffers)
+
+
+def iter_evaluate(stationary_terms, mat_a, mat_b, lengthscale,
+                  want=('k',), dtype=np.float64, max_bytes=MAX_BYTES):
+    """
+    Measures the kernel function and its gradients between solutions of A
+    and B tile by tile, so that only a tile of rows of A is held in memory
+    at once.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivative with respect to the squared distance element-wise to the
+     distance matrix.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns,
+     None or mat_a itself for the symmetric self-covariance.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param dtype: Floating point type of the computation, or MIXED.
+    :type dtype: np.dtype
+    :param max_bytes: Memory budget of the intermediate arrays of a tile.
+    :type max_bytes: int
+    :return: Generator of the first and last (excluded) rows of every tile,
+     and the requested outputs of those rows, in the same order as in want.
+    :rtype: generator """
+    check_want(want)
+    symmetric = mat_b is None or mat_b is mat_a
+    mat_a = np.asarray(mat_a)
+    mat_b = mat_a if symmetric else np.asarray(mat_b)
+    dtype, out_dtype = _precision(dtype, symmetric)
+    profiling = bolib.models.gp.kernels.profiling
+    if profiling.ENABLED:
+        profiling.count(profiling.kernel_name(stationary_terms), want,
+                        mat_a.shape, mat_b.shape)
+
+    for start, stop in tile_rows(mat_a, mat_b, want, out_dtype, max_bytes,
+                                 lengthscale=lengthscale):
+        yield start, stop, evaluate_rows(
+            stationary_terms, mat_a, mat_b, lengthscale, want,
+            [None] * len(want), dtype, symmetric, start, stop)
+
+
+def tile_rows(mat_a, mat_b, want, dtype=np.float64, max_bytes=MAX_BYTES,
+              min_tiles=1, lengthscale=None):
+    """
+    Splits the rows of A into tiles whose intermediate arrays fit in the
+    memory budget.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :param max_bytes: Memory budget of the intermediate arrays of a tile.
+    :type max_bytes: int
+    :param min_tiles: Minimum number of tiles, as long as there are rows.
+    :type min_tiles: int
+    :param lengthscale: Array of lenghtscale parameters, whose leading
+     dimensions, if any, stack several lengthscales.
+    :type lengthscale: np.array
+    :return: List of the first and last (excluded) rows of every tile.
+    :rtype: list """
+    shape = _output_shape(mat_a, mat_b, lengthscale, 'k')
+    n_rows = shape[-2]
+    # distance matrix, kernel value and derivative, plus the gradients
+    row_bytes = np.dtype(dtype).itemsize * \
+        int(np.prod(shape[:-2])) * shape[-1] * \
+        (3 + np.shape(mat_a)[-1] * (('dx' in want) + ('dl' in want)))
+    step = max(1, min(int(max_bytes // max(row_bytes, 1)),
+                      -(-n_rows // min_tiles)))
+
+    return [(start, min(start + step, n_rows))
+            for start in range(0, n_rows, step)]
+
+
+def evaluate_rows(stationary_terms, mat_a, mat_b, lengthscale, want,
+                  buffers, dtype, symmetric, start=None, stop=None,
+                  masks=(None, None)):
+    """
+    Measures the kernel function and its gradients between the rows of A
+    between start and stop and the solutions of B, the work of a single
+    tile of evaluate. The diagonal of symmetric evaluations is zeroed
+    exactly.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivative with respect to the squared distance element-wise to the
+     distance matrix.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns, mat_a
+     itself for symmetric evaluations.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :param buffers: Buffers to store the outputs of the rows in, in the
+     same order as in want. None entries are allocated.
+    :type buffers: list
+    :param dtype: Floating point type of the computation, or MIXED.
+    :type dtype: np.dtype
+    :param symmetric: Whether B is A itself.
+    :type symmetric: bool
+    :param start: First row of A.
+    :type start: int
+    :param stop: Last (excluded) row of A.
+    :type stop: int
+    :param masks: Optional boolean masks of the valid solutions of A and B.
+    :type masks: tuple
+    :return: Requested outputs of the rows, in the same order as in want.
+    :rtype: tuple """
+    tile_a = mat_a[..., start:stop, :]
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    if profile:
+        kernel = profiling.kernel_name(stationary_terms)
+        stamp = profiling.clock()
+    if _is_mixed(dtype):
+        # differences are taken in double precision and rounded once
+        dtype = np.float64
+        buffers = [np.empty(_output_shape(tile_a, mat_b, lengthscale, name),
+                            dtype=np.float32)
+                   if buffer is None and name != 'k' else buffer
+                   for name, buffer in zip(want, buffers)]
+        sq_dist = sq_distance_mixed(tile_a, mat_b, lengthscale)
+    else:
+        sq_dist = sq_distance_array(tile_a, mat_b, lengthscale, dtype)
+    if symmetric:
+        rows = np.arange(sq_dist.shape[-2])
+        sq_dist[..., rows, rows + (start or 0)] = 0.0
+    if profile:
+        stamp = profiling.record(kernel, 'distance', stamp, (sq_dist,))
+    value, grad_r2 = stationary_terms(
+        sq_dist, value='k' in want, gradient=wants_gradient(want),
+        overwrite=True)
+    if profile:
+        stamp = profiling.record(kernel, 'elementwise', stamp,
+                                 (value, grad_r2), reuse=sq_dist)
+    if masks[0] is not None:
+        masks = (np.asarray(masks[0])[..., start:stop], masks[1])
+
+    results = _outputs(_mask(value, masks), _mask(grad_r2, masks), tile_a,
+                       mat_b, lengthscale, want, buffers, dtype)
+    if profile:
+        profiling.record(kernel, 'gradient', stamp, _gradients(
+            results, want))
+
+    return results
+
+
+def _evaluate_panel(stationary_terms, scaled, norms, mat_a, lengthscale,
+                    want, buffers, dtype, start, stop, masks):
+    """ Measures the outputs of the rows of A from start to stop against the
+    solutions from start onwards, a panel of the upper triangle, into the
+    full buffers, and mirrors them into the lower triangle. """
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    if profile:
+        kernel = profiling.kernel_name(stationary_terms)
+        stamp = profiling.clock()
+    sq_dist = _sq_distance_panel(scaled, norms, start, stop)
+    if profile:
+        stamp = profiling.record(kernel, 'distance', stamp, (sq_dist,))
+    value, grad_r2 = stationary_terms(
+        sq_dist, value='k' in want, gradient=wants_gradient(want),
+        overwrite=True)
+    if profile:
+        stamp = profiling.record(kernel, 'elementwise', stamp,
+                                 (value, grad_r2), reuse=sq_dist)
+    masks = tuple(None if mask is None else np.asarray(mask)[..., rows]
+                  for mask, rows in zip(masks, (slice(start, stop),
+                                                slice(start, None))))
+
+    panels = [_panel(buffer, name, start, stop)
+              for name, buffer in zip(want, buffers)]
+    results = _outputs(_mask(value, masks), _mask(grad_r2, masks),
+                       mat_a[..., start:stop, :], mat_a[..., start:, :],
+                       lengthscale, want, panels, dtype)
+    for name, buffer in zip(want, buffers):
+        _mirror(buffer, name, start, stop)
+    if profile:
+        profiling.record(kernel, 'gradient', stamp, _gradients(
+            results, want))
+
+
+def _panel(buffer, name, start, stop):
+    """ View of the rows between start and stop, and of the columns from
+    start onwards, of an output buffer. """
+    trailing = (slice(None),) * (name != 'k')
+
+    return buffer[(Ellipsis, slice(start, stop), slice(start, None)) +
+                  trailing]
+
+
+def _mirror(buffer, name, start, stop):
+    """ Copies the panel of rows between start and stop of an output buffer
+    into the lower triangle, negated for the gradient in X, which is
+    antisymmetric. """
+    trailing = (slice(None),) * (name != 'k')
+    axes = (-2, -1) if name == 'k' else (-3, -2)
+    rows, cols = np.tril_indices(stop - start, -1)
+    rows += start
+    cols += start
+    below = (Ellipsis, slice(stop, None), slice(start, stop)) + trailing
+    above = (Ellipsis, slice(start, stop), slice(stop, None)) + trailing
+    if name == 'dx':
+        np.negative(np.swapaxes(buffer[above], *axes), out=buffer[below])
+        buffer[(Ellipsis, rows, cols) + trailing] = \
+            -buffer[(Ellipsis, cols, rows) + trailing]
+    else:
+        buffer[below] = np.swapaxes(buffer[above], *axes)
+        buffer[(Ellipsis, rows, cols) + trailing] = \
+            buffer[(Ellipsis, cols, rows) + trailing]
+
+
+def _outputs(value, grad_r2, mat_a, mat_b, lengthscale, want, buffers,
+             dtype):
+    """ Builds the requested outputs from the kernel terms, writing them
+    into the given buffers. """
+    buffers = dict(zip(want, buffers))
+    results = {'k': value}
+    if 'k' in want and buffers['k'] is not None:
+        buffers['k'][...] = value
+        results['k'] = buffers['k']
+    if 'dx' in want:
+        results['dx'] = dr_dx(
+            mat_a, mat_b, lengthscale, out=buffers['dx'], dtype=dtype,
+            stacked=True)
+        results['dx'] *= grad_r2[..., np.newaxis]
+    if 'dl' in want:
+        results['dl'] = dr_dl(
+            mat_a, mat_b, lengthscale, out=buffers['dl'], dtype=dtype,
+            stacked=True)
+        results['dl'] *= grad_r2[..., np.newaxis]
+
+    return tuple(results[name] for name in want)
+
+
+def _gradients(results, want):
+    """ Gradients among the outputs. """
+    return tuple(result for name, result in zip(want, results)
+                 if name != 'k')
+
+
+def _mask(array, masks, packed=False):
+    """ Zeroes, in place, the entries of padded solutions. """
+    mask_a, mask_b = masks
+    if array is None or (mask_a is None and mask_b is None):
+        return array
+
+    mask = np.logical_and(
+        True if mask_a is None else np.asarray(mask_a)[..., :, np.newaxis],
+        True if mask_b is None else np.asarray(mask_b)[..., np.newaxis, :])
+    if packed:
+        mask = pack_upper(mask)
+    array *= mask
+
+    return array
+
+
+def _is_mixed(dtype):
+    """ Whether dtype requests the mixed precision evaluation. """
+    return isinstance(dtype, str) and dtype == MIXED
+
+
+def _precision(dtype, symmetric):
+    """ Floating point type of the computation, which is never mixed for
+    symmetric evaluations, and of its outputs. """
+    if _is_mixed(dtype) and symmetric:
+        dtype = np.float64
+
+    return dtype, np.float32 if _is_mixed(dtype) else dtype
+
+
+def check_want(want):
+    """ Checks that every requested output is known.
+
+    :param want: Requested outputs.
+    :type want: tuple
+    :raises ValueError: If an output is not one of OUTPUTS. """
+    unknown = [name for name in want if name not in OUTPUTS]
+    if unknown:
+        raise ValueError("Unknown kernel outputs: {}".format(unknown))
+
+
+def wants_gradient(want):
+    """ Whether any gradient is requested.
+
+    :param want: Requested outputs.
+    :type want: tuple
+    :return: Whether 'dx' or 'dl' is among them.
+    :rtype: bool """
+    return 'dx' in want or 'dl' in want
+
+
+def map_tiles(function, tiles, n_jobs=1, executor=None):
+    """ Applies function to every tile, with the executor, a shared thread
+    pool of n_jobs threads or serially.
+
+    :param function: Function of a tile.
+    :type function: function
+    :param tiles: Tiles, as returned by tile_rows.
+    :type tiles: list
+    :param n_jobs: Number of threads, as returned by effective_n_jobs.
+    :type n_jobs: int
+    :param executor: Optional executor, with a map method, to apply the
+     function with instead.
+    :type executor: concurrent.futures.Executor
+    """
+    if executor is not None:
+        list(executor.map(function, tiles))
+    elif n_jobs > 1:
+        _thread_pool(n_jobs).map(function, tiles)
+    else:
+        for tile in tiles:
+            function(tile)
+
+
+_POOLS = {}
+
+_POOLS_LOCK = threading.Lock()
+
+
+def _thread_pool(n_jobs):
+    """ Thread pool of n_jobs threads, created on first use and shared by
+    every later evaluation, such as the products of an iterative solver,
+    in this process. """
+    key = (os.getpid(), n_jobs)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = multiprocessing.pool.ThreadPool(n_jobs)
+
+        return _POOLS[key]
+
+
+@atexit.register
+def _close_pools():
+    """ Closes the thread pools of this process and waits for their
+    threads. """
+    with _POOLS_LOCK:
+        for (pid, _), pool in list(_POOLS.items()):
+            if pid == os.getpid():
+                pool.close()
+                pool.join()
+        _POOLS.clear()
+
+
+def effective_n_jobs(n_jobs):
+    """ Number of threads, counting negative values back from the number of
+    processors plus one.
+
+    :param n_jobs: Requested number of threads, -1 for as many as
+     processors.
+    :type n_jobs: int
+    :return: Number of threads.
+    :rtype: int """
+    if n_jobs < 0:
+        n_jobs = max(1, multiprocessing.cpu_count() + 1 + n_jobs)
+
+    return n_jobs
+
+
+def _output_shape(mat_a, mat_b, lengthscale, name):
+    """ Shape of the requested output between solutions of A and B. """
+    batch = _broadcast_shape(
+        np.shape(mat_a)[:-2], np.shape(mat_b)[:-2],
+        () if lengthscale is None else as_lengthscale(lengthscale).shape[:-1])
+    shape = batch + (np.shape(mat_a)[-2], np.shape(mat_b)[-2])
+    if name != 'k':
+        shape += (np.shape(mat_a)[-1],)
+
+    return shape
+
+
+def _rows(buffer, name, start, stop):
+    """ View of the rows between start and stop of an output buffer. """
+    trailing = (slice(None),) * (1 if name == 'k' else 2)
+
+    return buffer[(Ellipsis, slice(start, stop)) + trailing]
+
+
+def kernel_diag(stationary_terms, mat_a, lengthscale, dtype=np.float64):
+    """
+    Measures the diagonal of the kernel matrix between solutions of A and
+    themselves, in linear time.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivative with respect to the squared distance element-wise to the
+     distance matrix.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: Kernel function of every solution with itself.
+    :rtype: np.array """
+    sq_dist = np.zeros(_broadcast_shape(
+        np.shape(mat_a)[:-1], as_lengthscale(lengthscale).shape[:-1] + (1,)),
+                       dtype=dtype)
+
+    return stationary_terms(sq_dist, gradient=False, overwrite=True)[0]
+
+
+def d2k_dx2(stationary_terms, mat_a, mat_b, lengthscale, diagonal=False,
+            dtype=np.float64):
+    """
+    Measures the second derivatives of the kernel function between solutions
+    of A and B in the solutions of A,
+    4 f''(r^2) u u^T + 2 f'(r^2) diag(l^-2), with u = (a - b) / l^2.
+
+    The distances are measured from the differences themselves, so that they
+    are exactly zero between equal solutions, where the singular terms of
+    the kernels are zero.
+
+    :param stationary_terms: Function that applies the kernel function and
+     its derivatives with respect to the squared distance element-wise to
+     the distance matrix.
+    :type stationary_terms: function
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns, None
+     for mat_a itself.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. A (L, d) array stacks L
+     lengthscales, adding a leading dimension of size L to the results.
+    :type lengthscale: np.array
+    :param diagonal: Whether to measure only the second derivatives in every
+     dimension, without the mixed ones.
+    :type diagonal: bool
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: (n, m, d, d) Hessians, or (n, m, d) diagonals.
+    :rtype: np.array """
+    mat_a = np.asarray(mat_a)
+    mat_b = mat_a if mat_b is None else np.asarray(mat_b)
+    profiling = bolib.models.gp.kernels.profiling
+    profile = profiling.ENABLED
+    if profile:
+        kernel = profiling.kernel_name(stationary_terms)
+        profiling.count(kernel, ('d2x_diag',) if diagonal else ('d2x',),
+                        mat_a.shape, mat_b.shape)
+        stamp = profiling.clock()
+    lengthscale = as_lengthscale(lengthscale, dtype)
+    inv_sq = np.power(lengthscale, -2.0)[..., np.newaxis, np.newaxis, :]
+    scaled = _difference(mat_a, mat_b, lengthscale, dtype=dtype)
+    sq_dist = np.einsum('...i,...i->...', scaled, scaled * inv_sq)
+    scaled *= inv_sq
+    if profile:
+        stamp = profiling.record(kernel, 'distance', stamp,
+                                 (scaled, sq_dist))
+    _, grad_r2, curv_r2 = stationary_terms(
+        sq_dist, value=False, overwrite=True, curvature=True)
+    curv_r2 *= 4.0
+    grad_r2 *= 2.0
+    if profile:
+        stamp = profiling.record(kernel, 'elementwise', stamp,
+                                 (grad_r2, curv_r2), reuse=sq_dist)
+
+    if diagonal:
+        result = np.square(scaled, out=scaled)
+        result *= curv_r2[..., np.newaxis]
+        result += grad_r2[..., np.newaxis] * inv_sq
+    else:
+        result = scaled[..., :, np.newaxis] * scaled[..., np.newaxis, :]
+        result *= curv_r2[..., np.newaxis, np.newaxis]
+        dims = np.arange(scaled.shape[-1])
+        result[..., dims, dims] += grad_r2[..., np.newaxis] * inv_sq
+    if profile:
+        profiling.record(kernel, 'gradient', stamp, (result,),
+                         reuse=scaled)
+
+    return result
+
+
+def as_matrix(array):
+    """ Wraps the results of the matrix API in np.matrix, unless they stack
+    several matrices.
+
+    :param array: Result array.
+    :type array: np.array
+    :return: Result matrix, or the array itself when it is not 2D.
+    :rtype: np.matrix """
+    return np.matrix(array) if np.ndim(array) == 2 else array
+
+
+def pad_batch(mats, dtype=np.float64):
+    """ Pads lists of solutions of different lengths into a single array
+    with a leading batch dimension, to evaluate them in one call.
+
+    :param mats: Lists of solutions in lines and dimensions in columns,
+     with the same number of dimensions.
+    :type mats: list
+    :param dtype: Floating point type of the padded array.
+    :type dtype: np.dtype
+    :return: Padded solutions with shape (B, n, d), where n is the longest
+     length and padded solutions are zero, and the (B, n) boolean mask of
+     the valid solutions.
+    :rtype: tuple """
+    mats = [np.asarray(mat, dtype=dtype) for mat in mats]
+    size = max(mat.shape[0] for mat in mats)
+
+    padded = np.zeros((len(mats), size, mats[0].shape[1]), dtype=dtype)
+    mask = np.zeros((len(mats), size), dtype=bool)
+    for index, mat in enumerate(mats):
+        padded[index, :mat.shape[0]] = mat
+        mask[index, :mat.shape[0]] = True
+
+    return padded, mask
+
+
+def pack_upper(mat):
+    """ Packs the upper triangle of symmetric matrices, row by row, into
+    its last dimension.
+
+    :param mat: Symmetric matrices in the last two dimensions.
+    :type mat: np.array
+    :return: Packed upper triangle, with n (n + 1) / 2 elements.
+    :rtype: np.array """
+    rows, cols = np.triu_indices(mat.shape[-1])
+
+    return mat[..., rows, cols]
+
+
+def unpack_upper(packed):
+    """ Unpacks the upper triangle packed by pack_upper into the full
+    symmetric matrices.
+
+    :param packed: Packed upper triangle in the last dimension.
+    :type packed: np.array
+    :return: Symmetric matrices in the last two dimensions.
+    :rtype: np.array """
+    size = int(round((np.sqrt(8 * packed.shape[-1] + 1) - 1) / 2))
+    if size * (size + 1) // 2 != packed.shape[-1]:
+        raise ValueError(
+            "{} elements are not a packed triangle".format(packed.shape[-1]))
+    rows, cols = np.triu_indices(size)
 
-    for i in range(0, mat_a.shape[0]):
-        result[i, :, :] = - 2.0 * (np.power(mat_a[i, :] - mat_b[:, :], 2.0)) /\
-            np.power(lengthscale, 3.0)
+    result = np.empty(packed.shape[:-1] + (size, size), dtype=packed.dtype)
+    result[..., rows, cols] = packed
+    result[..., cols, rows] = packed
 
     return result
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright 2017 Ibai Roman
+#
+#    This file is part of BOlib.
+#
+#    BOlib is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    BOlib is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+import bolib.models.gp.kernels.compact
+import bolib.models.gp.kernels.util
+
+# Like every Wendland function of d=3, phi_(3,2) is positive definite in
+# R^d for d <= 3 only.
+MAX_DIMS = 3
+
+
+def stationary_function(sq_dist):
+    r""" It applies the Wendland (d=3, k=2) kernel function
+    element-wise to the distance matrix.
+
+    .. math::
+        k_{W32}(r) = (1 - \dfrac{r}{l})_+^6 (1 + \dfrac{6r}{l} +
+        \dfrac{35r^2}{3l^2})
+
+    :param sq_dist: Distance matrix
+    :type sq_dist: np.matrix
+
+    :return: Result matrix with kernel function applied element-wise.
+    :rtype: np.matrix """
+    return bolib.models.gp.kernels.util.as_matrix(
+        stationary_terms(np.asarray(sq_dist), gradient=False)[0])
+
+
+def stationary_terms(sq_dist, value=True, gradient=True,
+                     overwrite=False):
+    """ It applies the Wendland (d=3, k=2) kernel function and its derivative
+    with respect to the squared distance element-wise to the distance
+    matrix, computing their shared terms only once, in place.
+
+    :param sq_dist: Distance matrix
+    :type sq_dist: np.array
+    :param value: Whether the kernel function is required.
+    :type value: bool
+    :param gradient: Whether the derivative with respect to the squared
+     distance is required.
+    :type gradient: bool
+    :param overwrite: Whether sq_dist may be used as a work buffer.
+    :type overwrite: bool
+
+    :return: Kernel function and its derivative applied element-wise, None
+     in place of the ones not required.
+    :rtype: tuple """
+    # with t = (1 - r)_+: k = t^6 (1 + 6 r + 35/3 r^2) and
+    # dk/dr^2 = -28/3 t^5 (1 + 5 r)
+    dist = np.sqrt(sq_dist, out=sq_dist if overwrite else None)
+    support = np.subtract(1.0, dist)
+    np.maximum(support, 0.0, out=support)
+    fifth = np.power(support, 5.0)
+    value_term = None
+    if value:
+        value_term = np.multiply(dist, 35.0 / 3.0)
+        value_term += 6.0
+        value_term *= dist
+        value_term += 1.0
+        value_term *= fifth
+        value_term *= support
+    grad_r2 = None
+    if gradient:
+        grad_r2 = np.multiply(dist, 5.0, out=dist)
+        grad_r2 += 1.0
+        grad_r2 *= fifth
+        grad_r2 *= -28.0 / 3.0
+    return value_term, grad_r2
+
+
+def kernel_function(mat_a, mat_b, lengthscale):
+    """ Finds the pairs of solutions of A and B within the support of the
+    kernel, and applies the kernel function to their distances.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.matrix
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.matrix
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise. It is also the support radius
+     of the kernel.
+    :type lengthscale: np.array
+    :return: Sparse kernel matrix.
+    :rtype: scipy.sparse.csr_matrix """
+    return evaluate(mat_a, mat_b, lengthscale, want=('k',))[0]
+
+
+def dk_dx(mat_a, mat_b, lengthscale):
+    """
+    Measures gradient of the kernel function in X.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.matrix
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.matrix
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :return: Sparse gradient of the kernel function in every dimension of
+     X, one matrix per dimension.
+    :rtype: list """
+    return evaluate(mat_a, mat_b, lengthscale, want=('dx',))[0]
+
+
+def dk_dl(mat_a, mat_b, lengthscale):
+    """
+    Measures gradient of the kernel function in the length-scale
+    hyper-parameter space.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.matrix
+    :param mat_b: List of solutions in lines and dimensions in columns.
+    :type mat_b: np.matrix
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :return: Sparse gradient of the kernel function in every dimension the
+     length-scale hyper-parameter space, one matrix per dimension.
+    :rtype: list """
+    return evaluate(mat_a, mat_b, lengthscale, want=('dl',))[0]
+
+
+def evaluate(mat_a, mat_b, lengthscale, want=('k', 'dx', 'dl')):
+    """
+    Measures the kernel function and its gradients in X and in the
+    length-scale hyper-parameter space at once, only for the pairs of
+    solutions within the support of the kernel.
+
+    :param mat_a: List of solutions in lines and dimensions in columns, in
+     up to MAX_DIMS dimensions.
+    :type mat_a: np.array
+    :param mat_b: List of solutions in lines and dimensions in columns,
+     None or mat_a itself for the symmetric self-covariance.
+    :type mat_b: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param want: Requested outputs: 'k', 'dx' and/or 'dl'.
+    :type want: tuple
+    :raises ValueError: If the solutions have more than MAX_DIMS
+     dimensions.
+    :return: Requested outputs, in the same order as in want: a sparse
+     kernel matrix and lists of sparse gradients, one per dimension.
+    :rtype: tuple """
+    return bolib.models.gp.kernels.compact.evaluate(
+        stationary_terms, mat_a, mat_b, lengthscale, want=want,
+        max_dims=MAX_DIMS)
+
+
+def kernel_diag(mat_a, lengthscale, dtype=np.float64):
+    """
+    Measures the diagonal of the kernel matrix between solutions of A and
+    themselves, in linear time.
+
+    :param mat_a: List of solutions in lines and dimensions in columns.
+    :type mat_a: np.array
+    :param lengthscale: Array of lenghtscale parameters. One per dimension
+     in ARD case, only one element otherwise.
+    :type lengthscale: np.array
+    :param dtype: Floating point type of the computation.
+    :type dtype: np.dtype
+    :return: Kernel function of every solution with itself.
+    :rtype: np.array """
+    return bolib.models.gp.kernels.util.kernel_diag(
+        stationary_terms, mat_a, lengthscale, dtype=dtype)
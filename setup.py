@@ -50,6 +50,10 @@ setup(
     install_requires=[
         'gplib',
         'numpy',
+        'scipy',
         'matplotlib'
-    ]
+    ],
+    extras_require={
+        'jit': ['numba']
+    }
 )
@@ -17,8 +17,16 @@
 #    You should have received a copy of the GNU General Public License
 #    along with BOlib. If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import multiprocessing.pool
+import threading
+
 import numpy as np
+import scipy.sparse.linalg
 
 import bolib.models.gp.kernels.matern52 as matern52
 import bolib.models.gp.kernels.matern32 as matern32
@@ -26,6 +34,20 @@ import bolib.models.gp.kernels.squared_exponential as squared_exponential
 import bolib.models.gp.kernels.exponential as exponential
 import bolib.models.gp.kernels.gamma_exponential15 as gamma_exponential15
 import bolib.models.gp.kernels.rational_quadratic2 as rational_quadratic2
+import bolib.models.gp.kernels.wendland31 as wendland31
+import bolib.models.gp.kernels.wendland32 as wendland32
+import bolib.models.gp.kernels.toeplitz as toeplitz
+import bolib.models.gp.kernels.util as util
+import bolib.models.gp.kernels.basis as basis
+import bolib.models.gp.kernels.candidates as candidates
+import bolib.models.gp.kernels.disk_cache as disk_cache
+import bolib.models.gp.kernels.fourier as fourier
+import bolib.models.gp.kernels.incremental as incremental
+import bolib.models.gp.kernels.jit as jit
+import bolib.models.gp.kernels.kronecker as kronecker
+import bolib.models.gp.kernels.linear_operator as linear_operator
+import bolib.models.gp.kernels.nystrom as nystrom
+import bolib.models.gp.kernels.profiling as profiling
 
 
 class KernelTest(unittest.TestCase):
@@ -157,3 +179,892 @@ class KernelTest(unittest.TestCase):
                          [-1.24995313e-03, 2.49990625e-01]]])
         np.testing.assert_allclose(kernel.dk_dx(
             mat_a, mat_b, lengthscale), res)
+
+    def test_evaluate(self):
+        """ Test of the fused evaluation of every kernel """
+        mat_a = np.matrix([[1.14, 14.1], [1.15, 13.1], [1.15, 12.1]])
+        mat_b = np.matrix([[-4.42, 14.11], [1.3, 13.6]])
+        lengthscale = np.matrix([[1.5, 0.7]])
+
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            k, dx, dl = kernel.evaluate(mat_a, mat_b, lengthscale)
+            np.testing.assert_allclose(
+                k, kernel.kernel_function(mat_a, mat_b, lengthscale))
+            np.testing.assert_allclose(
+                dx, kernel.dk_dx(mat_a, mat_b, lengthscale))
+            np.testing.assert_allclose(
+                dl, kernel.dk_dl(mat_a, mat_b, lengthscale))
+            for dim in range(mat_a.shape[1]):
+                step = np.zeros((1, mat_a.shape[1]))
+                step[0, dim] = 1e-6
+                num_dx = (kernel.kernel_function(
+                    mat_a + step, mat_b, lengthscale) -
+                          kernel.kernel_function(
+                              mat_a - step, mat_b, lengthscale)) / 2e-6
+                num_dl = (kernel.kernel_function(
+                    mat_a, mat_b, lengthscale + step) -
+                          kernel.kernel_function(
+                              mat_a, mat_b, lengthscale - step)) / 2e-6
+                np.testing.assert_allclose(
+                    dx[:, :, dim], np.array(num_dx), atol=1e-6)
+                np.testing.assert_allclose(
+                    dl[:, :, dim], np.array(num_dl), atol=1e-6)
+            dl, k = kernel.evaluate(
+                mat_a, mat_b, lengthscale, want=('dl', 'k'))
+            np.testing.assert_allclose(
+                k, kernel.kernel_function(mat_a, mat_b, lengthscale))
+
+    def test_gradient_buffers(self):
+        """ Test of the gradients written into preallocated buffers """
+        mat_a = np.matrix([[1.14, 14.1], [1.15, 13.1], [1.15, 12.1]])
+        mat_b = np.matrix([[-4.42, 14.11], [1.14, 14.1]])
+        lengthscale = np.matrix([[1.5, 0.7]])
+
+        for kernel in [matern52, exponential, rational_quadratic2]:
+            buffer = np.empty((3, 2, 2))
+            res = kernel.dk_dx(mat_a, mat_b, lengthscale, out=buffer)
+            self.assertIs(res, buffer)
+            np.testing.assert_allclose(
+                res, kernel.dk_dx(mat_a, mat_b, lengthscale))
+            res = kernel.dk_dl(mat_a, mat_b, lengthscale, out=buffer)
+            self.assertIs(res, buffer)
+            np.testing.assert_allclose(
+                res, kernel.dk_dl(mat_a, mat_b, lengthscale))
+
+    def test_array_dtype(self):
+        """ Test of the plain array evaluation in single precision """
+        mat_a = np.array([[1.14, 14.1], [1.15, 13.1], [1.15, 12.1]])
+        mat_b = np.array([[-4.42, 14.11], [1.14, 14.1]])
+        lengthscale = np.array([1.5, 0.7])
+
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            expected = kernel.evaluate(mat_a, mat_b, lengthscale)
+            results = kernel.evaluate(
+                mat_a, mat_b, lengthscale, dtype=np.float32)
+            for res, exp in zip(results, expected):
+                self.assertIs(type(res), np.ndarray)
+                self.assertEqual(res.dtype, np.float32)
+                self.assertTrue(res.flags.c_contiguous)
+                np.testing.assert_allclose(res, exp, rtol=1e-3, atol=1e-6)
+
+    def test_symmetric(self):
+        """ Test of the symmetric, packed and diagonal evaluations """
+        mat_a = np.array([[1.14, 14.1], [1.15, 13.1], [1.15, 12.1],
+                          [-4.42, 14.11]])
+        mat_b = mat_a.copy()
+        lengthscale = np.array([1.5, 0.7])
+
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            expected = kernel.evaluate(mat_a, mat_b, lengthscale)
+            results = kernel.evaluate(mat_a, None, lengthscale)
+            for res, exp in zip(results, expected):
+                np.testing.assert_allclose(res, exp, atol=1e-6)
+            np.testing.assert_array_equal(results[0], results[0].T)
+            np.testing.assert_array_equal(np.diag(results[0]), 1.0)
+            np.testing.assert_array_equal(
+                kernel.kernel_diag(mat_a, lengthscale), 1.0)
+
+            packed, = kernel.evaluate(
+                mat_a, mat_a, lengthscale, want=('k',), packed=True)
+            self.assertEqual(packed.shape, (10,))
+            np.testing.assert_array_equal(
+                util.unpack_upper(packed), results[0])
+
+        for size in [1, 7, 20]:
+            mat_x = np.random.RandomState(size).uniform(-1.0, 1.0, (size, 3))
+            sq_dist = util.sq_distance_packed(mat_x, lengthscale[:1])
+            np.testing.assert_allclose(sq_dist, util.pack_upper(
+                util.sq_distance_symmetric(mat_x, lengthscale[:1])),
+                                       atol=1e-12)
+            np.testing.assert_array_equal(
+                np.diag(util.unpack_upper(sq_dist)), 0.0)
+
+    def test_stationary_terms(self):
+        """ Test of the in-place element-wise terms """
+        sq_dist = np.array([[0.0, 0.3, 1.7], [4.2, 0.01, 9.0]])
+
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            value, grad_r2 = kernel.stationary_terms(sq_dist)
+            np.testing.assert_array_equal(
+                sq_dist, [[0.0, 0.3, 1.7], [4.2, 0.01, 9.0]])
+            np.testing.assert_allclose(
+                kernel.stationary_terms(sq_dist, gradient=False)[0], value)
+            np.testing.assert_allclose(
+                kernel.stationary_terms(sq_dist, value=False)[1], grad_r2)
+            np.testing.assert_allclose(kernel.stationary_terms(
+                sq_dist.copy(), overwrite=True)[1], grad_r2)
+            np.testing.assert_allclose(kernel.stationary_terms(
+                sq_dist.copy(), value=False, overwrite=True)[1], grad_r2)
+            np.testing.assert_allclose(kernel.stationary_terms(
+                sq_dist.copy(), gradient=False, overwrite=True)[0], value)
+            step = 1e-7
+            np.testing.assert_allclose(
+                (kernel.stationary_terms(sq_dist[:, 1:] + step)[0] -
+                 kernel.stationary_terms(sq_dist[:, 1:] - step)[0]) /
+                (2.0 * step), grad_r2[:, 1:], rtol=1e-5)
+
+    def test_tiles(self):
+        """ Test of the evaluation in tiles under a memory budget """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (23, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (7, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        for kernel in [matern52, exponential, rational_quadratic2]:
+            for other in [mat_b, mat_a]:
+                expected = kernel.evaluate(mat_a, other, lengthscale)
+                out = (np.zeros((23, other.shape[0])), None, None)
+                results = kernel.evaluate(mat_a, other, lengthscale,
+                                          out=out, max_bytes=2000)
+                self.assertIs(results[0], out[0])
+                for res, exp in zip(results, expected):
+                    np.testing.assert_allclose(res, exp, atol=1e-12)
+
+                tiles = list(kernel.iter_evaluate(
+                    mat_a, other, lengthscale, want=('k', 'dx'),
+                    max_bytes=2000))
+                self.assertGreater(len(tiles), 1)
+                for start, stop, (k, dx) in tiles:
+                    np.testing.assert_allclose(
+                        k, expected[0][start:stop], atol=1e-12)
+                    np.testing.assert_allclose(
+                        dx, expected[1][start:stop], atol=1e-12)
+
+    def test_threads(self):
+        """ Test of the evaluation of tiles in concurrent threads """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (40, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (9, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        pool = multiprocessing.pool.ThreadPool(3)
+        for kernel in [matern32, gamma_exponential15, squared_exponential]:
+            expected = kernel.evaluate(mat_a, mat_b, lengthscale)
+            for res, exp in zip(kernel.evaluate(mat_a, mat_b, lengthscale,
+                                                n_jobs=3), expected):
+                np.testing.assert_array_equal(res, exp)
+
+            expected = kernel.evaluate(mat_a, mat_b, lengthscale,
+                                       max_bytes=3000)
+            for res, exp in zip(kernel.evaluate(
+                    mat_a, mat_b, lengthscale, max_bytes=3000,
+                    executor=pool), expected):
+                np.testing.assert_array_equal(res, exp)
+
+            np.testing.assert_array_equal(
+                kernel.kernel_function(mat_a, mat_a, lengthscale, n_jobs=-1),
+                kernel.kernel_function(mat_a, mat_a, lengthscale))
+            expected = kernel.evaluate(mat_a, None, lengthscale)
+            for options in [{'n_jobs': 3}, {'executor': pool}]:
+                for res, exp in zip(kernel.evaluate(mat_a, None, lengthscale,
+                                                    **options), expected):
+                    np.testing.assert_array_equal(res, exp)
+            for options in [{'max_bytes': 3000},
+                            {'max_bytes': 3000, 'n_jobs': 3}]:
+                k, dx, dl = kernel.evaluate(mat_a, None, lengthscale,
+                                            **options)
+                np.testing.assert_array_equal(k, k.T)
+                np.testing.assert_array_equal(dx, -np.swapaxes(dx, 0, 1))
+                np.testing.assert_array_equal(dl, np.swapaxes(dl, 0, 1))
+                for res, exp in zip((k, dx, dl), expected):
+                    np.testing.assert_allclose(res, exp, atol=1e-12)
+        pool.close()
+        pool.join()
+
+        # the pool of the first evaluation is shared by the later ones
+        matern32.evaluate(mat_a, mat_b, lengthscale, n_jobs=2)
+        threads = threading.active_count()
+        for _ in range(3):
+            matern32.evaluate(mat_a, mat_b, lengthscale, n_jobs=2)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_incremental_gram(self):
+        """ Test of the kernel matrix extended with appended solutions """
+        mat_x = np.random.RandomState(0).uniform(-2.0, 2.0, (30, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        gram = incremental.IncrementalGram(
+            matern52, mat_x[:5], lengthscale, capacity=4)
+        for start, stop in [(5, 6), (6, 20), (20, 30)]:
+            res = gram.append(mat_x[start:stop])
+            np.testing.assert_allclose(res, matern52.kernel_function(
+                mat_x[:stop], mat_x[:stop], lengthscale), atol=1e-12)
+        self.assertEqual(gram.capacity, 40)
+        np.testing.assert_array_equal(gram.gram, gram.gram.T)
+        np.testing.assert_array_equal(np.diag(gram.gram), 1.0)
+
+    def test_candidate_cache(self):
+        """ Test of the cached kernel matrix against fixed candidates """
+        mat_c = np.random.RandomState(0).uniform(-2.0, 2.0, (50, 3))
+        mat_x = np.random.RandomState(1).uniform(-2.0, 2.0, (30, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        cache = candidates.CandidateCache(rational_quadratic2,
+                                          capacity=4)
+        for stop in [3, 4, 10, 30]:
+            res = cache.cross_covariance(mat_c, mat_x[:stop],
+                                         lengthscale)
+            np.testing.assert_allclose(
+                res, rational_quadratic2.kernel_function(
+                    mat_c, mat_x[:stop], lengthscale), atol=1e-12)
+        key = cache.key
+
+        res = cache.cross_covariance(mat_c, mat_x[5:], 2.0 * lengthscale)
+        self.assertNotEqual(cache.key, key)
+        np.testing.assert_allclose(res, rational_quadratic2.kernel_function(
+            mat_c, mat_x[5:], 2.0 * lengthscale), atol=1e-12)
+
+    def test_distance_basis(self):
+        """ Test of the kernel measured from a distance basis """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (20, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (7, 3))
+
+        for other in [None, mat_b]:
+            distances = basis.DistanceBasis(mat_a, other)
+            for lengthscale in [np.array([1.5, 0.7, 1.1]), np.array([0.8])]:
+                for kernel in [matern52, exponential, squared_exponential]:
+                    results = distances.evaluate(kernel, lengthscale)
+                    expected = kernel.evaluate(mat_a, other, lengthscale,
+                                               want=('k', 'dl'))
+                    for res, exp in zip(results, expected):
+                        np.testing.assert_allclose(res, exp, atol=1e-12)
+
+    def test_stacked_lengthscale(self):
+        """ Test of the evaluation of many lengthscales at once """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (11, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (7, 3))
+        lengthscales = np.random.RandomState(2).uniform(0.5, 2.0, (4, 3))
+
+        np.testing.assert_allclose(
+            util.sq_distance(mat_a, mat_b, lengthscales),
+            [util.sq_distance_array(mat_a, mat_b, lengthscale)
+             for lengthscale in lengthscales])
+        np.testing.assert_allclose(
+            util.dr_dl(mat_a, mat_b, lengthscales),
+            [util.dr_dl(mat_a, mat_b, lengthscale)
+             for lengthscale in lengthscales])
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            for other, options in [(mat_b, {}), (None, {}),
+                                   (mat_b, {'max_bytes': 3000})]:
+                results = kernel.evaluate(mat_a, other, lengthscales,
+                                          **options)
+                for index, lengthscale in enumerate(lengthscales):
+                    expected = kernel.evaluate(mat_a, other, lengthscale)
+                    for res, exp in zip(results, expected):
+                        np.testing.assert_allclose(res[index], exp,
+                                                   atol=1e-12)
+            self.assertEqual(
+                kernel.dk_dl(mat_a, mat_b, lengthscales).shape,
+                (4, 11, 7, 3))
+            self.assertEqual(
+                kernel.kernel_diag(mat_a, lengthscales).shape, (4, 11))
+
+            single, = kernel.evaluate(mat_a, mat_b, lengthscales[:1],
+                                      want=('k',))
+            self.assertEqual(single.shape, (1, 11, 7))
+            np.testing.assert_allclose(single[0], kernel.kernel_function(
+                mat_a, mat_b, np.matrix(lengthscales[:1])), atol=1e-12)
+            self.assertEqual(
+                kernel.evaluate(mat_a, None, lengthscales[:1],
+                                want=('dl',))[0].shape, (1, 11, 11, 3))
+
+    def test_row_lengthscale(self):
+        """ Test of (1, d) plain array lengthscales in the matrix API """
+        mat_a = np.matrix([[1.14, 14.1], [1.15, 13.1], [1.15, 12.1]])
+        mat_b = np.matrix([[-4.42, 14.11], [1.14, 14.1]])
+        lengthscale = np.array([[1.0, 1.0]])
+
+        res = matern52.kernel_function(mat_a, mat_b, lengthscale)
+        self.assertIsInstance(res, np.matrix)
+        np.testing.assert_allclose(res, [[2.58954726e-04, 1.00000000e+00],
+                                         [2.13404908e-04, 5.23965288e-01],
+                                         [1.29098963e-04, 1.38655010e-01]])
+        res = np.array([[[-4.96239014e-04, 8.92516211e-07],
+                         [-0.00000000e+00, -0.00000000e+00]],
+                        [[-4.03451123e-04, 7.31572055e-05],
+                         [-5.76395858e-03, 5.76395858e-01]],
+                        [[-2.34821135e-04, 8.47379680e-05],
+                         [-1.04174595e-03, 2.08349190e-01]]])
+        np.testing.assert_allclose(matern52.dk_dx(
+            mat_a, mat_b, lengthscale), res)
+        row = np.matrix(lengthscale)
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            np.testing.assert_array_equal(
+                kernel.kernel_function(mat_a, mat_b, lengthscale),
+                kernel.kernel_function(mat_a, mat_b, row))
+            for function in [kernel.dk_dx, kernel.dk_dl, kernel.d2k_dx2]:
+                res = function(mat_a, mat_b, lengthscale)
+                self.assertEqual(res.shape[:3], (3, 2, 2))
+                np.testing.assert_array_equal(
+                    res, function(mat_a, mat_b, row))
+        self.assertEqual(util.sq_distance(mat_a, mat_b, lengthscale).shape,
+                         (3, 2))
+        for function in [util.dr_dx, util.dr_dl]:
+            np.testing.assert_array_equal(
+                function(mat_a, mat_b, lengthscale),
+                function(mat_a, mat_b, row))
+
+    def test_batch(self):
+        """ Test of the evaluation of many padded datasets at once """
+        random = np.random.RandomState(0)
+        mats_a = [random.uniform(-2.0, 2.0, (size, 3)) for size in [4, 9, 6]]
+        mats_b = [random.uniform(-2.0, 2.0, (size, 3)) for size in [5, 2, 3]]
+        lengthscales = random.uniform(0.5, 2.0, (3, 3))
+        batch_a, mask_a = util.pad_batch(mats_a)
+        batch_b, mask_b = util.pad_batch(mats_b)
+
+        for kernel in [matern52, exponential, rational_quadratic2]:
+            crossed = kernel.evaluate(batch_a, batch_b, lengthscales,
+                                      mask_a=mask_a, mask_b=mask_b)
+            tiled = kernel.evaluate(batch_a, batch_b, lengthscales,
+                                    mask_a=mask_a, mask_b=mask_b,
+                                    max_bytes=2000)
+            own = kernel.evaluate(batch_a, None, lengthscales,
+                                  mask_a=mask_a)
+            for index, (mat_a, mat_b) in enumerate(zip(mats_a, mats_b)):
+                size_a, size_b = mat_a.shape[0], mat_b.shape[0]
+                expected = kernel.evaluate(mat_a, mat_b, lengthscales[index])
+                for res, tile, exp in zip(crossed, tiled, expected):
+                    np.testing.assert_allclose(
+                        res[index, :size_a, :size_b], exp, atol=1e-12)
+                    np.testing.assert_array_equal(res[index, size_a:], 0.0)
+                    np.testing.assert_array_equal(
+                        res[index, :, size_b:], 0.0)
+                    np.testing.assert_allclose(tile[index], res[index],
+                                               atol=1e-12)
+                expected = kernel.evaluate(mat_a, None, lengthscales[index])
+                for res, exp in zip(own, expected):
+                    np.testing.assert_allclose(
+                        res[index, :size_a, :size_a], exp, atol=1e-12)
+                    np.testing.assert_array_equal(res[index, size_a:], 0.0)
+
+    def test_mixed_precision(self):
+        """ Test of the mixed precision evaluation """
+        random = np.random.RandomState(0)
+        mat_a = random.uniform(100.0, 101.0, (40, 3))
+        mat_b = np.vstack([mat_a[:5] + 1e-4, random.uniform(100.0, 101.0,
+                                                            (20, 3))])
+        lengthscale = np.array([0.5, 0.7, 1.1])
+
+        expected = np.sum(np.square(
+            (mat_a[:, np.newaxis, :] - mat_b) / lengthscale), axis=-1)
+        res = util.sq_distance_mixed(mat_a, mat_b, lengthscale)
+        self.assertEqual(res.dtype, np.float32)
+        np.testing.assert_allclose(res, expected,
+                                   rtol=util.MIXED_RTOL + 1e-7)
+        self.assertGreater(np.max(np.abs(util.sq_distance_array(
+            mat_a, mat_b, lengthscale, np.float32) / expected - 1.0)),
+                           util.MIXED_RTOL)
+
+        for kernel in [matern52, squared_exponential]:
+            k, dx = kernel.evaluate(mat_a, mat_b, lengthscale,
+                                    want=('k', 'dx'), dtype=util.MIXED)
+            self.assertEqual(k.dtype, np.float32)
+            self.assertEqual(dx.dtype, np.float32)
+            exp_k, exp_dx = kernel.evaluate(mat_a, mat_b, lengthscale,
+                                            want=('k', 'dx'))
+            np.testing.assert_allclose(k, exp_k, rtol=1e-3, atol=1e-6)
+            np.testing.assert_allclose(dx, exp_dx, rtol=1e-3, atol=1e-5)
+            k, = kernel.evaluate(mat_a, None, lengthscale, want=('k',),
+                                 dtype=util.MIXED)
+            self.assertEqual(k.dtype, np.float64)
+
+    def test_compiled_backend(self):
+        """ Test of the fused loops against the NumPy backend """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (5, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (4, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        enabled = jit.ENABLED
+        try:
+            jit.ENABLED = False
+            expected = dict(
+                (kernel, kernel.evaluate(mat_a, mat_b, lengthscale))
+                for kernel in [matern52, matern32, squared_exponential,
+                               exponential, gamma_exponential15,
+                               rational_quadratic2])
+            exp_dr = (util.dr_dx(mat_a, mat_b, lengthscale),
+                      util.dr_dl(mat_a, mat_b, lengthscale))
+            exp_sq = util.sq_distance(mat_a, mat_b, lengthscale)
+            jit.ENABLED = True
+            for kernel, exp in expected.items():
+                results = kernel.evaluate(mat_a, mat_b, lengthscale)
+                loops = jit.evaluate(kernel.scalar_terms, mat_a, mat_b,
+                                     lengthscale, util.OUTPUTS, [None] * 3)
+                for res, loop_res, exp_res in zip(results, loops, exp):
+                    np.testing.assert_allclose(res, exp_res, atol=1e-12)
+                    np.testing.assert_allclose(loop_res, exp_res,
+                                               atol=1e-12)
+                k, = kernel.evaluate(mat_a, None, lengthscale, want=('k',))
+                np.testing.assert_array_equal(np.diag(k), 1.0)
+            np.testing.assert_allclose(
+                util.dr_dx(mat_a, mat_b, lengthscale), exp_dr[0])
+            np.testing.assert_allclose(
+                util.dr_dl(mat_a, mat_b, lengthscale), exp_dr[1])
+            np.testing.assert_allclose(
+                util.sq_distance(mat_a, mat_b, lengthscale), exp_sq)
+            np.testing.assert_allclose(
+                jit.dr_dx(mat_a, mat_b, lengthscale), exp_dr[0])
+            np.testing.assert_allclose(
+                jit.dr_dl(mat_a, mat_b, lengthscale), exp_dr[1])
+            np.testing.assert_allclose(
+                jit.sq_distance(mat_a, mat_b, lengthscale), exp_sq)
+
+            fused, calls = jit.evaluate, []
+
+            def counted(*args, **kwargs):
+                """ Counts the evaluations of the fused loop. """
+                calls.append(kwargs.get('n_jobs'))
+                return fused(*args, **kwargs)
+
+            jit.evaluate = counted
+            try:
+                matern52.evaluate(mat_a, mat_b, lengthscale, n_jobs=2)
+                matern52.evaluate(mat_a, None, lengthscale)
+                single = matern52.evaluate(mat_a, mat_b, lengthscale,
+                                           dtype=np.float32)
+                matern52.evaluate(mat_a, mat_b, lengthscale,
+                                  max_bytes=2 ** 20)
+            finally:
+                jit.evaluate = fused
+            self.assertEqual(calls, [2] if jit.available() else [])
+            for res, exp_res in zip(single, expected[matern52]):
+                self.assertEqual(res.dtype, np.float32)
+                np.testing.assert_allclose(res, exp_res, rtol=1e-4,
+                                           atol=1e-5)
+        finally:
+            jit.ENABLED = enabled
+
+    def test_compact_support(self):
+        """ Test of the sparse compactly supported kernels """
+        mat_a = np.random.RandomState(0).uniform(-3.0, 3.0, (40, 2))
+        mat_b = np.random.RandomState(1).uniform(-3.0, 3.0, (30, 2))
+        lengthscale = np.array([1.5, 0.7])
+
+        for kernel in [wendland31, wendland32]:
+            expected = util.evaluate(kernel.stationary_terms, mat_a, mat_b,
+                                     lengthscale)
+            k_mat, grad_x, grad_l = kernel.evaluate(mat_a, mat_b,
+                                                    lengthscale)
+            self.assertLess(k_mat.nnz, k_mat.shape[0] * k_mat.shape[1])
+            np.testing.assert_allclose(k_mat.toarray(), expected[0],
+                                       atol=1e-12)
+            for dim in range(2):
+                np.testing.assert_allclose(grad_x[dim].toarray(),
+                                           expected[1][..., dim], atol=1e-12)
+                np.testing.assert_allclose(grad_l[dim].toarray(),
+                                           expected[2][..., dim], atol=1e-12)
+            np.testing.assert_allclose(
+                kernel.dk_dx(mat_a, mat_b, lengthscale)[1].toarray(),
+                expected[1][..., 1], atol=1e-12)
+
+            k_self = kernel.kernel_function(mat_a, mat_a, lengthscale)
+            np.testing.assert_array_equal(k_self.diagonal(), 1.0)
+
+            mat_x = np.zeros((3, kernel.MAX_DIMS + 1))
+            with self.assertRaises(ValueError):
+                kernel.kernel_function(mat_x, mat_x, 1.0)
+            np.testing.assert_allclose(
+                k_self.toarray(), k_self.toarray().T)
+
+    def test_random_features(self):
+        """ Test of the random Fourier feature approximation """
+        mat_a = np.random.RandomState(0).uniform(-1.0, 1.0, (6, 2))
+        mat_b = np.random.RandomState(1).uniform(-1.0, 1.0, (5, 2))
+        lengthscale = np.array([1.5, 0.7])
+
+        for kernel in [matern52, matern32, squared_exponential,
+                       rational_quadratic2]:
+            feature_map = fourier.RandomFeatures(kernel, 2, 20000,
+                                                 random_state=0)
+            np.testing.assert_allclose(
+                feature_map.kernel_function(mat_a, mat_b, lengthscale),
+                kernel.kernel_function(mat_a, mat_b, lengthscale),
+                atol=0.05)
+
+            phi, grad_x, grad_l = fourier.RandomFeatures(
+                kernel, 2, 50, random_state=1).evaluate(mat_a, lengthscale)
+            feature_map = fourier.RandomFeatures(kernel, 2, 50,
+                                                 random_state=1)
+            np.testing.assert_allclose(
+                feature_map.features(mat_a, lengthscale), phi)
+            step = 1e-6
+            for dim in range(2):
+                delta = np.zeros(2)
+                delta[dim] = step
+                np.testing.assert_allclose(
+                    (feature_map.features(mat_a + delta, lengthscale) -
+                     feature_map.features(mat_a - delta, lengthscale)) /
+                    (2.0 * step), grad_x[..., dim], atol=1e-6)
+                np.testing.assert_allclose(
+                    (feature_map.features(mat_a, lengthscale + delta) -
+                     feature_map.features(mat_a, lengthscale - delta)) /
+                    (2.0 * step), grad_l[..., dim], atol=1e-6)
+
+    def test_nystrom(self):
+        """ Test of the Nystrom low-rank approximation """
+        mat_x = np.random.RandomState(0).uniform(-2.0, 2.0, (30, 2))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (4, 2))
+        lengthscale = np.array([1.5, 0.7])
+
+        for method in nystrom.SELECTION_METHODS:
+            indices = nystrom.select_inducing(
+                matern52, mat_x, lengthscale, 12, method=method,
+                random_state=0)
+            self.assertEqual(len(set(indices)), 12)
+
+        exact = nystrom.Nystroem(squared_exponential, mat_x[:8], jitter=0.0)
+        np.testing.assert_allclose(
+            exact.kernel_function(mat_x[:8], mat_b, lengthscale),
+            squared_exponential.kernel_function(mat_x[:8], mat_b,
+                                                lengthscale), atol=1e-8)
+        np.testing.assert_allclose(
+            exact.dk_dl(mat_x[:8], lengthscale),
+            squared_exponential.dk_dl(mat_x[:8], mat_x[:8], lengthscale),
+            atol=1e-6)
+
+        approx = nystrom.Nystroem(matern52, mat_x[nystrom.select_inducing(
+            matern52, mat_x, lengthscale, 12)])
+        step = 1e-6
+        grad_x = approx.dk_dx(mat_b, mat_x, lengthscale)
+        grad_l = approx.dk_dl(mat_x, lengthscale)
+        for dim in range(2):
+            delta = np.zeros(2)
+            delta[dim] = step
+            np.testing.assert_allclose(
+                (approx.kernel_function(mat_b + delta, mat_x, lengthscale) -
+                 approx.kernel_function(mat_b - delta, mat_x, lengthscale)) /
+                (2.0 * step), grad_x[..., dim], atol=1e-6)
+            np.testing.assert_allclose(
+                (approx.kernel_function(mat_x, mat_x, lengthscale + delta) -
+                 approx.kernel_function(mat_x, mat_x, lengthscale - delta)) /
+                (2.0 * step), grad_l[..., dim], atol=1e-5)
+
+    def test_kronecker_grid(self):
+        """ Test of the Kronecker structured kernel matrix of a grid """
+        axes = [np.linspace(-1.0, 1.0, 4), np.linspace(0.0, 2.0, 3),
+                np.array([0.3, 1.1])]
+        lengthscale = np.array([1.5, 0.7, 1.1])
+        vec = np.random.RandomState(0).normal(size=(24, 2))
+
+        gram = kronecker.KroneckerGram(squared_exponential, axes,
+                                       lengthscale)
+        points = gram.points()
+        expected = np.asarray(squared_exponential.kernel_function(
+            points, points, lengthscale))
+        np.testing.assert_allclose(gram.dense(), expected, atol=1e-12)
+        np.testing.assert_allclose(gram.matvec(vec), np.dot(expected, vec))
+        np.testing.assert_allclose(gram.matvec(vec[:, 0]),
+                                   np.dot(expected, vec[:, 0]))
+        np.testing.assert_allclose(
+            np.sort(gram.eigenvalues()), np.linalg.eigvalsh(expected),
+            atol=1e-10)
+        np.testing.assert_allclose(
+            gram.solve(vec, noise=0.1),
+            np.linalg.solve(expected + 0.1 * np.eye(24), vec))
+
+        grad_l = squared_exponential.dk_dl(points, points, lengthscale)
+        products = gram.dk_dl_matvec(vec)
+        for dim in range(3):
+            np.testing.assert_allclose(
+                products[dim], np.dot(grad_l[..., dim], vec), atol=1e-12)
+
+        gram = kronecker.KroneckerGram(matern52, axes, lengthscale)
+        expected = np.ones((24, 24))
+        for dim in range(3):
+            expected *= np.asarray(matern52.kernel_function(
+                points[:, dim:dim + 1], points[:, dim:dim + 1],
+                lengthscale[dim:dim + 1]))
+        np.testing.assert_allclose(gram.matvec(vec), np.dot(expected, vec))
+
+    def test_toeplitz(self):
+        """ Test of the Toeplitz kernel matrix of equally spaced points """
+        mat_x = np.linspace(0.5, 4.0, 15).reshape(-1, 1)
+        lengthscale = np.array([0.8])
+        vec = np.random.RandomState(0).normal(size=(15, 3))
+
+        self.assertAlmostEqual(toeplitz.regular_spacing(mat_x), 0.25)
+        self.assertIsNone(toeplitz.regular_spacing(np.square(mat_x)))
+        self.assertRaises(ValueError, toeplitz.ToeplitzGram, matern52,
+                          np.square(mat_x), lengthscale)
+
+        for kernel in [matern52, exponential, rational_quadratic2]:
+            gram = toeplitz.ToeplitzGram(kernel, mat_x, lengthscale)
+            expected = np.asarray(kernel.kernel_function(
+                mat_x, mat_x, lengthscale))
+            np.testing.assert_allclose(gram.dense(), expected, atol=1e-12)
+            np.testing.assert_allclose(gram.matvec(vec),
+                                       np.dot(expected, vec), atol=1e-12)
+            np.testing.assert_allclose(gram.matvec(vec[:, 0]),
+                                       np.dot(expected, vec[:, 0]),
+                                       atol=1e-12)
+            np.testing.assert_allclose(
+                gram.solve(vec, noise=0.01),
+                np.linalg.solve(expected + 0.01 * np.eye(15), vec))
+
+    def test_linear_operator(self):
+        """ Test of the matrix-free kernel matrix products """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (23, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (7, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+        vec = np.random.RandomState(2).normal(size=(23, 2))
+
+        k_aa, grad_l = matern52.evaluate(mat_a, None, lengthscale,
+                                         want=('k', 'dl'))
+        k_ab, = matern52.evaluate(mat_a, mat_b, lengthscale, want=('k',))
+        for n_jobs in [1, 3]:
+            operator = linear_operator.KernelOperator(
+                matern52, mat_a, None, lengthscale, noise=0.1,
+                max_bytes=2000, n_jobs=n_jobs)
+            np.testing.assert_allclose(operator.matmat(vec),
+                                       np.dot(k_aa, vec) + 0.1 * vec)
+            np.testing.assert_allclose(operator.matvec(vec[:, 0]),
+                                       np.dot(k_aa, vec[:, 0]) +
+                                       0.1 * vec[:, 0])
+            products = operator.dk_dl_matmat(vec)
+            for dim in range(3):
+                np.testing.assert_allclose(
+                    products[dim], np.dot(grad_l[..., dim], vec))
+            solution, info = scipy.sparse.linalg.cg(
+                operator, vec[:, 0], rtol=1e-10, atol=0.0)
+            self.assertEqual(info, 0)
+            np.testing.assert_allclose(
+                solution, np.linalg.solve(k_aa + 0.1 * np.eye(23),
+                                          vec[:, 0]), atol=1e-6)
+
+        operator = linear_operator.KernelOperator(
+            matern52, mat_a, mat_b, lengthscale, max_bytes=2000)
+        np.testing.assert_allclose(operator.matmat(vec[:7]),
+                                   np.dot(k_ab, vec[:7]))
+        np.testing.assert_allclose(operator.rmatvec(vec[:, 0]),
+                                   np.dot(k_ab.T, vec[:, 0]))
+
+    def test_d2k_dx2(self):
+        """ Test of the second derivatives in X """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (4, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (5, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+        step = 1e-6
+
+        for kernel in [matern52, matern32, squared_exponential, exponential,
+                       gamma_exponential15, rational_quadratic2]:
+            hessian = kernel.d2k_dx2(mat_a, mat_b, lengthscale)
+            self.assertEqual(hessian.shape, (4, 5, 3, 3))
+            np.testing.assert_allclose(
+                kernel.d2k_dx2(mat_a, mat_b, lengthscale, diagonal=True),
+                np.diagonal(hessian, axis1=-2, axis2=-1))
+            for dim in range(3):
+                delta = np.zeros(3)
+                delta[dim] = step
+                np.testing.assert_allclose(
+                    (kernel.dk_dx(mat_a + delta, mat_b, lengthscale) -
+                     kernel.dk_dx(mat_a - delta, mat_b, lengthscale)) /
+                    (2.0 * step), hessian[..., dim, :], rtol=1e-5,
+                    atol=1e-7)
+
+            hessian = kernel.d2k_dx2(mat_a, None, lengthscale)
+            self.assertTrue(np.all(np.isfinite(hessian)))
+            np.testing.assert_allclose(hessian, np.swapaxes(hessian, -1, -2))
+
+        curvature = squared_exponential.d2k_dx2(mat_a, None, lengthscale)
+        np.testing.assert_allclose(
+            curvature[0, 0], -np.diag(np.power(lengthscale, -2.0)))
+
+    def test_prepared_kernel(self):
+        """ Test of the kernels bound to a training set """
+        mat_x = np.random.RandomState(0).uniform(-2.0, 2.0, (9, 3))
+        mat_a = np.random.RandomState(1).uniform(-2.0, 2.0, (2, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        for kernel, prepared in [
+                (matern52, matern52.Matern52),
+                (matern32, matern32.Matern32),
+                (squared_exponential, squared_exponential.SquaredExponential),
+                (exponential, exponential.Exponential),
+                (gamma_exponential15, gamma_exponential15.GammaExponential15),
+                (rational_quadratic2, rational_quadratic2.RationalQuadratic2)]:
+            bound = prepared(mat_x, lengthscale)
+            self.assertFalse(hasattr(bound, '__dict__'))
+            k_mat, grad_x = bound.evaluate(mat_a)
+            exp_k, exp_dx = kernel.evaluate(mat_a, mat_x, lengthscale,
+                                            want=('k', 'dx'))
+            np.testing.assert_allclose(k_mat, exp_k)
+            np.testing.assert_allclose(grad_x, exp_dx, atol=1e-12)
+            np.testing.assert_allclose(bound.kernel_function(mat_a[0]),
+                                       exp_k[:1])
+            np.testing.assert_allclose(bound.dk_dx(mat_a[1]), exp_dx[1:],
+                                       atol=1e-12)
+
+    def test_profiling(self):
+        """ Test of the opt-in instrumentation of the kernels """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (6, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (4, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+        reports = []
+
+        enabled = jit.ENABLED
+        try:
+            jit.ENABLED = False
+            with profiling.Profile(callback=reports.append) as profile:
+                self.assertTrue(profiling.ENABLED)
+                matern52.evaluate(mat_a, mat_b, lengthscale)
+                matern52.kernel_function(mat_a, mat_a, lengthscale)
+                exponential.evaluate(mat_a, None, lengthscale,
+                                     want=('k', 'dx'), max_bytes=500)
+        finally:
+            jit.ENABLED = enabled
+        self.assertFalse(profiling.ENABLED)
+        self.assertEqual(reports, [profile.report()])
+
+        report = profile.report()
+        self.assertEqual(report['matern52']['calls'], 2)
+        self.assertEqual(report['matern52']['outputs'],
+                         {'k,dx,dl': 1, 'k': 1})
+        self.assertEqual(report['matern52']['shapes'],
+                         {'(6, 3) x (4, 3)': 1, '(6, 3) x (6, 3)': 1})
+        stages = report['exponential']['stages']
+        self.assertGreater(stages['distance']['count'], 1)
+        # the panels of the upper triangle, mirrored into the lower one
+        self.assertEqual(stages['gradient']['bytes'], 6 * 7 // 2 * 3 * 8)
+        for stage in ['distance', 'elementwise', 'gradient']:
+            self.assertEqual(report['matern52']['stages'][stage]['count'],
+                             2)
+        self.assertEqual(json.loads(profile.to_json()), report)
+
+    def test_profiling_entry_points(self):
+        """ Test of the instrumentation of the paths beyond util.evaluate """
+        mat_x = np.random.RandomState(0).uniform(-2.0, 2.0, (12, 3))
+        mat_a = np.random.RandomState(1).uniform(-2.0, 2.0, (2, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+
+        with profiling.Profile() as profile:
+            bound = matern52.Matern52(mat_x, lengthscale)
+            for row in mat_a:
+                bound.evaluate(row)
+            operator = linear_operator.KernelOperator(
+                matern32, mat_x, None, lengthscale, noise=0.1)
+            scipy.sparse.linalg.cg(operator, np.ones(12), maxiter=3)
+            operator.dk_dl_matmat(np.ones(12))
+            gram = incremental.IncrementalGram(
+                exponential, mat_x[:4], lengthscale)
+            gram.append(mat_x[4:])
+            candidates.CandidateCache(exponential).cross_covariance(
+                mat_a, mat_x, lengthscale)
+            basis.DistanceBasis(mat_x).evaluate(
+                squared_exponential, lengthscale)
+            wendland31.evaluate(mat_x, None, lengthscale)
+            rational_quadratic2.d2k_dx2(mat_a, mat_x, lengthscale)
+            nystrom.Nystroem(rational_quadratic2, mat_x[:5]).dk_dl(
+                mat_x, lengthscale)
+        report = profile.report()
+
+        self.assertEqual(report['matern52']['calls'], 2)
+        self.assertEqual(report['matern52']['outputs'], {'k,dx': 2})
+        for stage in ['distance', 'elementwise', 'gradient']:
+            self.assertEqual(report['matern52']['stages'][stage]['count'],
+                             2)
+        self.assertGreaterEqual(report['matern32']['calls'], 4)
+        self.assertEqual(report['matern32']['outputs']['dl'], 1)
+        self.assertEqual(report['matern32']['calls'], report['matern32'][
+            'stages']['distance']['count'])
+        self.assertEqual(report['exponential']['calls'], 3)
+        self.assertEqual(report['squared_exponential']['outputs'],
+                         {'k,dl': 1})
+        self.assertEqual(report['basis']['stages']['distance']['count'], 1)
+        self.assertEqual(report['wendland31']['calls'], 1)
+        self.assertEqual(report['rational_quadratic2']['outputs']['d2x'], 1)
+        self.assertGreater(
+            report['rational_quadratic2']['stages']['solve']['count'], 0)
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = disk_cache.DiskCache(directory)
+            with profiling.Profile() as profile:
+                for _ in range(2):
+                    cache.kernel_function(matern52, mat_a, mat_x,
+                                          lengthscale)
+            report = profile.report()
+            stages = report['matern52']['stages']
+            self.assertEqual(report['matern52']['calls'], 2)
+            self.assertEqual(stages['distance']['count'] +
+                             stages['fused']['count'], 1)
+            self.assertEqual(
+                report['disk_cache']['stages']['cache']['count'], 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_disk_cache(self):
+        """ Test of the on-disk cache of kernel matrices """
+        mat_a = np.random.RandomState(0).uniform(-2.0, 2.0, (6, 3))
+        mat_b = np.random.RandomState(1).uniform(-2.0, 2.0, (4, 3))
+        lengthscale = np.array([1.5, 0.7, 1.1])
+        directory = tempfile.mkdtemp()
+
+        try:
+            cache = disk_cache.DiskCache(directory)
+            expected = matern52.evaluate(mat_a, mat_b, lengthscale,
+                                         want=('k',))[0]
+            for _ in range(2):
+                res = cache.kernel_function(matern52, mat_a, mat_b,
+                                            lengthscale)
+                np.testing.assert_array_equal(res, expected)
+                # the same read-only entry, measured or loaded
+                self.assertIsInstance(res, np.memmap)
+                self.assertFalse(res.flags.writeable)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(cache.kernel_function(
+                matern52, mat_a, mat_b, lengthscale, np.float32).dtype,
+                np.float32)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            np.testing.assert_array_equal(cache.kernel_function(
+                matern52, mat_a, mat_b, lengthscale, util.MIXED),
+                matern52.evaluate(mat_a, mat_b, lengthscale, want=('k',),
+                                  dtype=util.MIXED)[0])
+            self.assertEqual(len(os.listdir(directory)), 3)
+            self.assertEqual(disk_cache.key(u'matern52', mat_a),
+                             disk_cache.key('matern52', mat_a))
+            self.assertEqual(cache.size, sum(
+                os.path.getsize(os.path.join(directory, name))
+                for name in os.listdir(directory)))
+            np.testing.assert_allclose(
+                cache.kernel_function(matern32, mat_a, None, lengthscale),
+                matern32.evaluate(mat_a, None, lengthscale,
+                                  want=('k',))[0])
+            np.testing.assert_allclose(
+                disk_cache.DiskCache(directory).sq_distance(
+                    mat_a, mat_b, lengthscale),
+                util.sq_distance_array(mat_a, mat_b, lengthscale))
+
+            cache.distance_basis(mat_a)
+            distance_basis = disk_cache.DiskCache(directory).distance_basis(
+                mat_a)
+            self.assertIsInstance(distance_basis.sq_diff, np.memmap)
+            np.testing.assert_allclose(
+                distance_basis.evaluate(matern52, lengthscale)[0],
+                basis.DistanceBasis(mat_a).evaluate(matern52,
+                                                    lengthscale)[0])
+            self.assertIsNone(cache.get(disk_cache.key('missing')))
+
+            recent = cache.path(
+                disk_cache.key('distance_basis', True, mat_a, mat_a))
+            for name in os.listdir(directory):
+                os.utime(os.path.join(directory, name), (1.0, 1.0))
+            os.utime(recent, (2.0, 2.0))
+            cache.max_bytes = os.path.getsize(recent)
+            cache.evict()
+            self.assertEqual(os.listdir(directory), [
+                os.path.basename(recent)])
+
+            # other files are left, leftovers of interrupted writes are not
+            with open(os.path.join(directory, 'other.npy'), 'wb'):
+                pass
+            with open(recent + '.1.tmp', 'wb') as output:
+                output.write(b'partial')
+            cache.clear()
+            self.assertEqual(os.listdir(directory), ['other.npy'])
+        finally:
+            shutil.rmtree(directory)